@@ -0,0 +1,244 @@
+# Benchmark for the GPX travel time path, runs entirely offline on synthetic data
+# A synthetic corridor (signals along a gently curving arterial, written as a KML with the signal points and the
+# corridor line, plus the matching CSV) and a set of GPX traces driving it are generated with a fixed seed, then
+# each stage is timed separately (the corridor and signals are taken straight from the generator, so the KML
+# parser is not part of the benchmark): parse (cold and cached), match (radius index, corridor matcher, nearest
+# intersection), travel times, table building and Excel export. Results are written as JSON so runs on different
+# commits can be compared with --compare.
+#
+# python gpx_benchmark.py --points 20000 --signals 40 --files 4 --output bench/this_commit.json
+# python gpx_benchmark.py --compare bench/last_commit.json bench/this_commit.json
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+
+import gpx_tracks
+from gpx_tracks import Track, IntersectionIndex, hit_pairs
+from gpx_map_matching import CorridorMatcher
+from gpx_observations import nearest_intersections
+import gpx_travel_times
+
+BENCHMARK_VERSION = 1
+START_TIME = datetime(2024, 5, 1, 13, 0, 0, tzinfo=timezone.utc)  # 7:00 local
+
+
+# Function to lay out a corridor: signal positions along a gently curving line heading east
+def generate_corridor(signals, spacing_m=400, seed=0):
+    rng = np.random.default_rng(seed)
+    lat0, lon0 = 40.70, -111.95
+    # corridor vertices every 50 m with a slow sideways wander
+    length = spacing_m * (signals + 1)
+    chainage = np.arange(0, length + 50, 50.0)
+    sideways = 40 * np.sin(chainage / 1500) + np.cumsum(rng.normal(0, 0.5, len(chainage)))
+    lat = lat0 + np.degrees(sideways / 6371000)
+    lon = lon0 + np.degrees(chainage / (6371000 * np.cos(np.radians(lat0))))
+    # signals on the line, starting one spacing in so the corridor extends past the first and last signal
+    signal_chainage = spacing_m * np.arange(1, signals + 1)
+    intersections = [{'route_id': f'R{i}', 'segment_id': f'S{i}',
+                      'lat': float(np.interp(c, chainage, lat)), 'lon': float(np.interp(c, chainage, lon))}
+                     for i, c in enumerate(signal_chainage)]
+    return {'name': 'Corridor', 'lat': lat.tolist(), 'lon': lon.tolist(), 'chainage': chainage}, intersections
+
+# Function to drive the corridor: one trace of `points` trackpoints with GPS noise (meters) and dropouts
+# (the fraction of points lost, half as scattered points and half as gaps of up to a minute)
+def generate_trace(corridor, points, noise_m=5.0, dropout=0.0, reverse=False, seed=0, interval_s=1.0):
+    rng = np.random.default_rng(seed)
+    chainage = corridor['chainage']
+    # speed alternates between cruising and stopping at signals, but the trace always covers the corridor
+    speed = np.clip(rng.normal(12, 4, points), 0, None) * (rng.random(points) > 0.15)
+    position = np.cumsum(speed * interval_s)
+    position = position / position[-1] * chainage[-1]
+    if reverse:
+        position = chainage[-1] - position
+    lat = np.interp(position, chainage, corridor['lat']) + np.degrees(rng.normal(0, noise_m, points) / 6371000)
+    lon = np.interp(position, chainage, corridor['lon']) + np.degrees(rng.normal(0, noise_m, points) / (6371000 * np.cos(np.radians(40.7))))
+    epoch = START_TIME.timestamp() + interval_s * np.arange(points)
+
+    keep = np.ones(points, dtype=bool)
+    if dropout > 0:
+        keep &= rng.random(points) > dropout / 2
+        lost = int(points * dropout / 2)
+        while lost > 0:
+            gap = int(min(lost, rng.integers(5, 60)))
+            start = rng.integers(0, max(1, points - gap))
+            keep[start:start + gap] = False
+            lost -= gap
+    return Track(lat[keep], lon[keep], epoch[keep], np.full(keep.sum(), 1300.0))
+
+# Function to write a track as GPX 1.1 (UTC times with milliseconds, the way the field loggers write them)
+def write_gpx(track, gpx_file):
+    times = pd.to_datetime(track.time, unit='s').strftime('%Y-%m-%dT%H:%M:%S.%f').str[:-3]
+    with open(gpx_file, 'w') as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                   '<gpx version="1.1" creator="gpx_benchmark" xmlns="http://www.topografix.com/GPX/1/1">\n<trk><trkseg>\n')
+        file.writelines(f'<trkpt lat="{la:.7f}" lon="{lo:.7f}"><ele>{el:.1f}</ele><time>{t}Z</time></trkpt>\n'
+                        for la, lo, el, t in zip(track.lat, track.lon, track.elevation, times))
+        file.write('</trkseg></trk>\n</gpx>\n')
+
+# Function to write the corridor KML (signal Points and the corridor LineString in one folder) and CSV
+def write_intersections(corridor, intersections, kml_file, csv_file):
+    placemarks = [f'<Placemark><name>{i["segment_id"]}</name><Point><coordinates>{i["lon"]:.7f},{i["lat"]:.7f},0</coordinates></Point></Placemark>'
+                  for i in intersections]
+    line = ' '.join(f'{lo:.7f},{la:.7f},0' for la, lo in zip(corridor['lat'], corridor['lon']))
+    placemarks.append(f'<Placemark><name>{corridor["name"]}</name><LineString><coordinates>{line}</coordinates></LineString></Placemark>')
+    with open(kml_file, 'w') as file:
+        file.write('<?xml version="1.0" encoding="UTF-8"?>\n<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+                   '<Document><name>benchmark</name><Folder><name>signals</name>\n' + '\n'.join(placemarks) + '\n</Folder></Document>\n</kml>\n')
+    pd.DataFrame({'routeID': [i['route_id'] for i in intersections], 'segmentID': [i['segment_id'] for i in intersections],
+                  'x': [i['lat'] for i in intersections], 'y': [i['lon'] for i in intersections]}).to_csv(csv_file, index=False)
+
+# Function to generate the whole synthetic study into a folder
+def generate_study(folder, points, signals, files, noise_m, dropout, seed):
+    corridor, intersections = generate_corridor(signals, seed=seed)
+    gpx_folder = os.path.join(folder, 'gpx')
+    os.makedirs(gpx_folder, exist_ok=True)
+    write_intersections(corridor, intersections, os.path.join(folder, 'signals.kml'), os.path.join(folder, 'signals.csv'))
+    for k in range(files):
+        track = generate_trace(corridor, points, noise_m, dropout, reverse=bool(k % 2), seed=seed + 1 + k)
+        write_gpx(track, os.path.join(gpx_folder, f'run_{k:03d}.gpx'))
+    return corridor, intersections
+
+# Function to time a stage: best and median wall time over `repeat` runs after one untimed warm-up run
+def time_stage(name, func, repeat, items):
+    func()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    result = {'stage': name, 'items': items, 'repeat': repeat,
+              'min_s': min(times), 'median_s': float(np.median(times)), 'items_per_s': items / min(times) if min(times) > 0 else None}
+    print(f"{name:<28} min {result['min_s'] * 1000:10.2f} ms   median {result['median_s'] * 1000:10.2f} ms   ({items} items)")
+    return result
+
+# Function to run every stage on a generated study
+def run_benchmark(folder, corridor, intersections, repeat):
+    corridors = [corridor]
+    gpx_files = gpx_travel_times.list_gpx_files(os.path.join(folder, 'gpx'))
+    cache_dir = os.path.join(folder, 'cache')
+    results = []
+
+    tracks = [Track.from_gpx(gpx_file, cache_dir='') for gpx_file in gpx_files]
+    points = sum(len(track) for track in tracks)
+    results.append(time_stage('parse_gpx', lambda: [Track.from_gpx(f, cache_dir='') for f in gpx_files], repeat, points))
+    for gpx_file in gpx_files:
+        Track.from_gpx(gpx_file, cache_dir=cache_dir)
+    results.append(time_stage('parse_gpx_cached', lambda: [Track.from_gpx(f, cache_dir=cache_dir) for f in gpx_files], repeat, points))
+
+    results.append(time_stage('haversine', lambda: [track.distances() for track in tracks], repeat, points))
+    index = IntersectionIndex(intersections, 30)
+    results.append(time_stage('match_radius', lambda: [hit_pairs(index.match(t.lat, t.lon)) for t in tracks], repeat, points))
+    matcher = CorridorMatcher(corridors, intersections)
+    results.append(time_stage('match_corridor', lambda: [matcher.crossings(t) for t in tracks], repeat, points))
+    # the gpx_observations mapping: nearest intersection of every point
+    key_intersections = pd.DataFrame({'Latitude': [i['lat'] for i in intersections],
+                                      'Longitude': [i['lon'] for i in intersections],
+                                      'Intersection': range(len(intersections))})
+    results.append(time_stage('match_nearest', lambda: [nearest_intersections(t.lat, t.lon, key_intersections) for t in tracks], repeat, points))
+
+    # travel times read through the parsed-track cache, as a repeat run over a study folder would
+    travel = lambda m=None: [gpx_travel_times.parse_gpx_file(f, intersections, index, m) for f in gpx_files]
+    default_cache_dir = gpx_tracks.GPX_CACHE_DIR
+    gpx_tracks.GPX_CACHE_DIR = cache_dir
+    try:
+        results.append(time_stage('travel_times_radius', travel, repeat, points))
+        results.append(time_stage('travel_times_corridor', lambda: travel(matcher), repeat, points))
+        final_result = pd.concat(travel(), ignore_index=True)
+    finally:
+        gpx_tracks.GPX_CACHE_DIR = default_cache_dir
+    segments = len(final_result)
+    results.append(time_stage('build_tables', lambda: gpx_travel_times.build_tables(final_result), repeat, segments))
+
+    filtered_df, pivoted_df = gpx_travel_times.build_tables(final_result)
+    output_file = os.path.join(folder, 'output.xlsx')
+    def export():
+        with pd.ExcelWriter(output_file, engine='xlsxwriter', datetime_format='yyyy-mm-dd hh:mm:ss') as writer:
+            filtered_df.to_excel(writer, sheet_name='Sheet1')
+            pivoted_df.to_excel(writer, sheet_name='Sheet2')
+    results.append(time_stage('export_xlsx', export, repeat, len(filtered_df)))
+    return results
+
+# Function to describe the machine and code the benchmark ran on
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds')}
+
+# Function to print the speed-up of every stage between two result files
+def compare(before_file, after_file):
+    with open(before_file) as file:
+        before = json.load(file)
+    with open(after_file) as file:
+        after = json.load(file)
+    if before['parameters'] != after['parameters']:
+        print("Warning: the two runs used different parameters, the comparison is not like for like.")
+    before_stages = {r['stage']: r for r in before['results']}
+    print(f"{'stage':<28}{'before ms':>12}{'after ms':>12}{'speed-up':>10}")
+    for r in after['results']:
+        b = before_stages.get(r['stage'])
+        if b is None:
+            print(f"{r['stage']:<28}{'':>12}{r['min_s'] * 1000:12.2f}")
+            continue
+        print(f"{r['stage']:<28}{b['min_s'] * 1000:12.2f}{r['min_s'] * 1000:12.2f}{b['min_s'] / r['min_s']:9.2f}x")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark of the GPX travel time stages on a synthetic corridor.")
+    parser.add_argument('--points', type=int, default=20000, help="trackpoints per GPX file before dropouts (default 20000)")
+    parser.add_argument('--signals', type=int, default=40, help="significant intersections on the corridor (default 40)")
+    parser.add_argument('--files', type=int, default=4, help="GPX files, alternating direction (default 4)")
+    parser.add_argument('--noise', type=float, default=5.0, help="GPS noise standard deviation in meters (default 5)")
+    parser.add_argument('--dropout', type=float, default=0.05, help="fraction of trackpoints lost (default 0.05)")
+    parser.add_argument('--seed', type=int, default=0, help="random seed (default 0)")
+    parser.add_argument('--repeat', type=int, default=5, help="timed runs per stage (default 5)")
+    parser.add_argument('--workdir', help="folder for the generated study (default: a temporary folder, removed afterwards)")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="compare two result files and exit")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    parameters = {'points': args.points, 'signals': args.signals, 'files': args.files, 'noise': args.noise,
+                  'dropout': args.dropout, 'seed': args.seed, 'repeat': args.repeat}
+    folder = args.workdir or tempfile.mkdtemp(prefix='gpx_benchmark_')
+    try:
+        corridor, intersections = generate_study(folder, args.points, args.signals, args.files, args.noise, args.dropout, args.seed)
+        results = run_benchmark(folder, corridor, intersections, args.repeat)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    report = {'benchmark_version': BENCHMARK_VERSION, 'environment': environment(), 'parameters': parameters, 'results': results}
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Results have been written to {args.output}")
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
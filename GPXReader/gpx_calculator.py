@@ -1,23 +1,8 @@
 import csv
-import math
+import numpy as np
 import pandas as pd
-from datetime import datetime
-import gpxpy
 import os
-
-# Function to calculate distance between two points using Haversine formula
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371000  # Radius of Earth in meters
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    delta_phi = math.radians(lat2 - lat1)
-    delta_lambda = math.radians(lon2 - lon1)
-    a = math.sin(delta_phi/2) * math.sin(delta_phi/2) + \
-        math.cos(phi1) * math.cos(phi2) * \
-        math.sin(delta_lambda/2) * math.sin(delta_lambda/2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    distance = R * c
-    return distance
+from gpx_tracks import Track, IntersectionIndex, hit_pairs, haversine
 
 # Function to find the closest significant intersection for a given point
 def find_closest_intersection(point, intersections):
@@ -30,31 +15,16 @@ def find_closest_intersection(point, intersections):
             closest_intersection = intersection
     return closest_intersection
 
-# Function to calculate travel time between two timestamps
-def calculate_travel_time(start_time, end_time):
-    start_datetime = datetime.strptime(start_time, '%Y-%m-%dT%H:%M:%SZ')
-    end_datetime = datetime.strptime(end_time, '%Y-%m-%dT%H:%M:%SZ')
-    return (end_datetime - start_datetime).total_seconds()
-
-# Parse GPX file
-
-
-# Function to parse GPX files in a folder
+# Function to parse GPX files in a folder into one columnar track (files joined end to end)
 def parse_gpx_files(folder_path):
-    gpx_data = []
+    tracks = []
     # Iterate over each file in the folder
     for filename in os.listdir(folder_path):
         if filename.endswith('.gpx'):  # Check if the file is a GPX file
             file_path = os.path.join(folder_path, filename)
             # Parse the GPX file
-            with open(file_path, 'r') as gpx_file:
-                gpx = gpxpy.parse(gpx_file)
-                # Extract data from GPX
-                for track in gpx.tracks:
-                    for segment in track.segments:
-                        for point in segment.points:
-                            gpx_data.append({'lat': point.latitude, 'lon': point.longitude, 'time': point.time.strftime('%Y-%m-%dT%H:%M:%SZ')})
-    return gpx_data
+            tracks.append(Track.from_gpx(file_path))
+    return Track.concat(tracks)
 
 # Example usage
 folder_path = 'GPXReader/data/'
@@ -68,39 +38,19 @@ with open('GPXReader/data/routes.csv', 'r') as csvfile:
     for row in reader:
         intersections.append({'route_id': row['routeID'], 'segment_id': row['segmentID'], 'lat': float(row['x']), 'lon': float(row['y'])})
 
-# Initialize variables
-prev_intersection = None
-output_data = []
+# Find the first significant intersection within 15 m (50 feet) of every point, then pair consecutive hits
+matches = IntersectionIndex(intersections, 15).match(gpx_data.lat, gpx_data.lon)
+_, start_point, point, prev_intersection, intersection = hit_pairs(matches)
 
-# Iterate through each point in GPX data
-for point in gpx_data:
-    closest_intersection = None
-    # Iterate through each significant intersection
-    for intersection in intersections:
-        # Calculate the distance between the current point and the intersection
-        distance = haversine(point['lat'], point['lon'], intersection['lat'], intersection['lon'])
-        # Check if the distance is within the threshold (100 feet)
-        if distance <= 15:  # 50 feet in meters
-            closest_intersection = intersection
-            # assign the time of the current point to the closest intersection
-            closest_intersection['time'] = point['time']
-            break  # Exit the loop if a significant intersection is found within the threshold
-    # If a closest intersection is found within the threshold, process it
-    if closest_intersection:
-        if prev_intersection:
-            # Calculate travel time between the previous intersection and the current closest intersection
-            travel_time = calculate_travel_time(prev_intersection['time'], point['time'])
-            # Store the segment start, segment finish, and travel time in the output data
-            output_data.append({'segment_start': prev_intersection['segment_id'], 'segment_finish': closest_intersection['segment_id'], 'travel_time': travel_time})
-        prev_intersection = closest_intersection
-    else:
-        # If no significant intersection is found within the threshold, skip to the next point
-        continue
-
-
-
-# Convert output data to DataFrame
-output_df = pd.DataFrame(output_data)
+# Travel time in whole seconds from integer epoch times (time stamps have always been read to the second)
+seconds = gpx_data.epoch_seconds()
+segment_ids = np.array([i['segment_id'] for i in intersections], dtype=object)
+
+# Store the segment start, segment finish, and travel time in the output data
+output_df = pd.DataFrame({
+    'segment_start': segment_ids[prev_intersection],
+    'segment_finish': segment_ids[intersection],
+    'travel_time': (seconds[point] - seconds[start_point]).astype(np.float64)})
 
 print(output_df)
 
@@ -1,9 +1,8 @@
 import os
-import gpxpy
 import csv
-import math
+import numpy as np
 import pandas as pd
-from datetime import datetime
+from gpx_tracks import Track, IntersectionIndex, hit_pairs
 
 # Function to parse CSV file containing significant intersection information
 def parse_csv(csv_file):
@@ -14,68 +13,26 @@ def parse_csv(csv_file):
             intersections.append({'route_id': row['routeID'], 'segment_id': row['segmentID'], 'lat': float(row['x']), 'lon': float(row['y'])})
     return intersections
 
-# Function to calculate distance between two points using Haversine formula
-def haversine(lat1, lon1, lat2, lon2):
-    # Haversine formula implementation
-    R = 6371000  # Radius of Earth in meters
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    delta_phi = math.radians(lat2 - lat1)
-    delta_lambda = math.radians(lon2 - lon1)
-    a = math.sin(delta_phi/2) * math.sin(delta_phi/2) + \
-        math.cos(phi1) * math.cos(phi2) * \
-        math.sin(delta_lambda/2) * math.sin(delta_lambda/2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    distance = R * c
-    return distance
-
-# Function to calculate travel time between two timestamps
-def calculate_travel_time(start_time, end_time):
-    start_datetime = datetime.strptime(start_time, '%Y-%m-%dT%H:%M:%SZ')
-    end_datetime = datetime.strptime(end_time, '%Y-%m-%dT%H:%M:%SZ')
-    return (end_datetime - start_datetime).total_seconds()
-
 # Function to parse GPX file and calculate travel times
 def parse_gpx_file(gpx_file, intersections):
-    gpx_data = []
-    # Parse the GPX file
-    with open(gpx_file, 'r') as gpx_file:
-        gpx = gpxpy.parse(gpx_file)
-        # Extract data from GPX
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    gpx_data.append({'lat': point.latitude, 'lon': point.longitude, 'time': point.time.strftime('%Y-%m-%dT%H:%M:%SZ')})
-
-    # Initialize variables
-    output_data = []  # Initialize output data list
-    prev_intersection = None  # Initialize previous intersection
-
-    # Iterate through each point in GPX data
-    for point in gpx_data:
-        closest_intersection = None
-        # Iterate through each significant intersection
-        for intersection in intersections:
-            # Calculate the distance between the current point and the intersection
-            distance = haversine(point['lat'], point['lon'], intersection['lat'], intersection['lon'])
-            # Check if the distance is within the threshold (50 feet)
-            if distance <= 15:  # 50 feet in meters
-                closest_intersection = intersection
-                # Assign the time of the current point to the closest intersection
-                closest_intersection['time'] = point['time']
-                break  # Exit the loop if a significant intersection is found within the threshold
-
-        # If a closest intersection is found within the threshold, process it
-        if closest_intersection:
-            if prev_intersection:
-                # Calculate travel time between the previous intersection and the current closest intersection
-                travel_time = calculate_travel_time(prev_intersection['time'], point['time'])
-                # Store the segment start, segment finish, and travel time in the output data
-                output_data.append({'route_ID': prev_intersection['route_id'] + ' / ' + closest_intersection['route_id'], 'segment_start': prev_intersection['segment_id'], 'segment_finish': closest_intersection['segment_id'], 'travel_time': travel_time})
-            prev_intersection = closest_intersection
-
-    # Convert output data to DataFrame
-    output_df = pd.DataFrame(output_data)
+    # Parse the GPX file into columnar arrays
+    track = Track.from_gpx(gpx_file)
+
+    # Find the first significant intersection within 15 m (50 feet) of every point, then pair consecutive hits
+    matches = IntersectionIndex(intersections, 15).match(track.lat, track.lon)
+    _, start_point, point, prev_intersection, intersection = hit_pairs(matches)
+
+    # Travel time in whole seconds from integer epoch times (time stamps have always been read to the second)
+    seconds = track.epoch_seconds()
+    route_ids = np.array([i['route_id'] for i in intersections], dtype=object)
+    segment_ids = np.array([i['segment_id'] for i in intersections], dtype=object)
+
+    # Store the segment start, segment finish, and travel time in the output data
+    output_df = pd.DataFrame({
+        'route_ID': route_ids[prev_intersection] + ' / ' + route_ids[intersection],
+        'segment_start': segment_ids[prev_intersection],
+        'segment_finish': segment_ids[intersection],
+        'travel_time': (seconds[point] - seconds[start_point]).astype(np.float64)})
     return output_df
 
 
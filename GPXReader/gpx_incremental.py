@@ -0,0 +1,101 @@
+# Incremental processing of a GPX folder that keeps growing through the day
+# A store folder keeps a manifest (manifest.json) of every GPX file already processed, with its size, modified
+# time and content hash, and the segment table each file produced (segments.pkl). On a refresh only new or
+# modified files are parsed; deleted files are dropped from the store. The store is reset whenever the settings
+# that produced it (intersection file contents, matching mode) change.
+
+import json
+import os
+import pickle
+import tempfile
+
+from gpx_tracks import file_digest
+
+MANIFEST_VERSION = 1
+
+
+class IncrementalStore:
+    """Manifest and per-file segment tables for one study folder."""
+
+    def __init__(self, store_dir, settings):
+        self.store_dir = store_dir
+        self.manifest_path = os.path.join(store_dir, 'manifest.json')
+        self.segments_path = os.path.join(store_dir, 'segments.pkl')
+        self.settings = dict(settings, version=MANIFEST_VERSION)
+        self.files = {}
+        self.segments = {}
+
+        manifest = self._read_manifest()
+        if manifest is None:
+            return
+        if manifest.get('settings') != self.settings:
+            print(f"Settings changed since {store_dir} was built; reprocessing every GPX file.")
+            return
+        try:
+            with open(self.segments_path, 'rb') as file:
+                segments = pickle.load(file)
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            print(f"Could not read stored segments in {store_dir} ({e}); reprocessing every GPX file.")
+            return
+        # Only trust files that are in both the manifest and the stored segments
+        self.files = {name: entry for name, entry in manifest.get('files', {}).items() if name in segments}
+        self.segments = {name: segments[name] for name in self.files}
+
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_path, 'r') as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            print(f"Could not read {self.manifest_path} ({e}); reprocessing every GPX file.")
+            return None
+
+    def pending(self, gpx_files):
+        """GPX files that are new or modified since they were stored, and forget files that no longer exist."""
+        names = {os.path.basename(gpx_file) for gpx_file in gpx_files}
+        for name in [name for name in self.files if name not in names]:
+            del self.files[name]
+            del self.segments[name]
+
+        pending = []
+        for gpx_file in gpx_files:
+            entry = self.files.get(os.path.basename(gpx_file))
+            stat = os.stat(gpx_file)
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+                continue
+            # A touched or copied file with the same contents keeps its stored result
+            if entry is not None and entry['size'] == stat.st_size and entry['sha256'] == file_digest(gpx_file):
+                entry['mtime'] = stat.st_mtime_ns
+                continue
+            pending.append(gpx_file)
+        return pending
+
+    def update(self, gpx_file, result):
+        stat = os.stat(gpx_file)
+        name = os.path.basename(gpx_file)
+        self.files[name] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': file_digest(gpx_file)}
+        self.segments[name] = result
+
+    def discard(self, gpx_file):
+        """Forget a file's stored result (a modified file that failed to process), so it is retried next time."""
+        name = os.path.basename(gpx_file)
+        self.files.pop(name, None)
+        self.segments.pop(name, None)
+
+    def results(self):
+        """Stored segment tables in filename order (the same order a full run concatenates them in)."""
+        return [self.segments[name] for name in sorted(self.segments)]
+
+    def save(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        # Segments first, then the manifest, each written to a temporary file and swapped in
+        self._write(self.segments_path, 'wb', lambda file: pickle.dump(self.segments, file, protocol=pickle.HIGHEST_PROTOCOL))
+        self._write(self.manifest_path, 'w', lambda file: json.dump({'settings': self.settings, 'files': self.files}, file, indent=1))
+
+    def _write(self, path, mode, dump):
+        fd, tmp_path = tempfile.mkstemp(dir=self.store_dir)
+        with os.fdopen(fd, mode) as file:
+            dump(file)
+        os.replace(tmp_path, path)
+
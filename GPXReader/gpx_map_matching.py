@@ -0,0 +1,128 @@
+# Corridor-aware matching of GPX traces to significant intersections
+# Instead of waiting for a trackpoint to land within a fixed radius of a signal, every trackpoint is projected
+# onto the corridor polyline(s) from the KML to get its linear reference (distance along the route). Each signal
+# gets a linear reference the same way, and the time a trace crosses a signal is interpolated between the two
+# trackpoints either side of it. Sparse or noisy logs no longer miss signals, and crossing times are sub-second.
+
+import numpy as np
+
+from gpx_tracks import EARTH_RADIUS_M
+
+
+class Corridor:
+    """A polyline in a local planar projection (meters) with the distance along it at each vertex."""
+
+    def __init__(self, lat, lon, name=None):
+        self.name = name
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        # Equirectangular projection around the corridor's centre (accurate to well under a meter over a corridor)
+        self.lat0 = float(np.mean(lat))
+        self.lon0 = float(np.mean(lon))
+        self.x, self.y = self.to_xy(lat, lon)
+        self.dx = np.diff(self.x)
+        self.dy = np.diff(self.y)
+        self.length2 = self.dx ** 2 + self.dy ** 2
+        self.chainage = np.concatenate([[0.0], np.cumsum(np.sqrt(self.length2))])
+
+    def to_xy(self, lat, lon):
+        x = np.radians(np.subtract(lon, self.lon0)) * EARTH_RADIUS_M * np.cos(np.radians(self.lat0))
+        y = np.radians(np.subtract(lat, self.lat0)) * EARTH_RADIUS_M
+        return x, y
+
+    def project(self, lat, lon, chunk_cells=4_000_000):
+        """Linear reference (m along the corridor) and offset (m from it) of each point, vectorized in chunks."""
+        px, py = self.to_xy(np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64))
+        measure = np.empty(len(px))
+        offset = np.empty(len(px))
+        n_segments = len(self.dx)
+        chunk_size = max(1, chunk_cells // max(1, n_segments))
+        safe_length2 = np.where(self.length2 > 0, self.length2, 1.0)
+        for start in range(0, len(px), chunk_size):
+            stop = start + chunk_size
+            rx = px[start:stop, None] - self.x[None, :-1]
+            ry = py[start:stop, None] - self.y[None, :-1]
+            # position along each segment (0-1), clamped to the segment ends
+            t = np.clip((rx * self.dx + ry * self.dy) / safe_length2, 0.0, 1.0)
+            distance2 = (rx - t * self.dx) ** 2 + (ry - t * self.dy) ** 2
+            nearest = np.argmin(distance2, axis=1)
+            rows = np.arange(len(nearest))
+            measure[start:stop] = self.chainage[nearest] + t[rows, nearest] * np.sqrt(self.length2[nearest])
+            offset[start:stop] = np.sqrt(distance2[rows, nearest])
+        return measure, offset
+
+
+class CorridorMatcher:
+    """Interpolates the times a track crosses each significant intersection along one or more corridors.
+
+    Each intersection is referenced to the corridor it lies closest to. Intersections more than `max_offset`
+    meters from every corridor are skipped, as are trackpoints more than `max_offset` meters from the corridor
+    being matched. Crossings are not interpolated across gaps in the log longer than `max_gap` seconds.
+    """
+
+    def __init__(self, corridors, intersections, max_offset=50, max_gap=120):
+        self.corridors = [Corridor(c['lat'], c['lon'], c.get('name')) for c in corridors if len(c['lat']) >= 2]
+        self.intersections = intersections
+        self.max_offset = max_offset
+        self.max_gap = max_gap
+        if not self.corridors:
+            raise ValueError("No corridor LineStrings with at least two vertices were found.")
+
+        lat = np.array([i['lat'] for i in intersections], dtype=np.float64)
+        lon = np.array([i['lon'] for i in intersections], dtype=np.float64)
+        projections = [corridor.project(lat, lon) for corridor in self.corridors]
+        offsets = np.array([offset for _, offset in projections])
+        closest = np.argmin(offsets, axis=0) if len(lat) else np.array([], dtype=np.int64)
+
+        # (intersection numbers, linear references) per corridor
+        self.signals = []
+        for c, (measure, offset) in enumerate(projections):
+            on_corridor = np.flatnonzero((closest == c) & (offset <= max_offset))
+            self.signals.append((on_corridor, measure[on_corridor]))
+        skipped = [intersections[i]['segment_id'] for i in np.flatnonzero(offsets.min(axis=0) > max_offset)] if len(lat) else []
+        if skipped:
+            print(f"Skipping intersections more than {max_offset} m from the corridor: {', '.join(map(str, skipped))}")
+
+    def crossings(self, track, chunk_cells=4_000_000):
+        """Times (epoch seconds, float) and intersection numbers of every signal crossing, in time order.
+
+        Back-and-forth crossings of the same signal (GPS jitter while queued at the stop bar) collapse to the last one.
+        The (point pairs x signals) crossing test runs in chunks of pairs so memory stays bounded for long traces.
+        """
+        times = []
+        signals = []
+        for corridor, (signal_ids, signal_measure) in zip(self.corridors, self.signals):
+            if len(signal_ids) == 0 or len(track) < 2:
+                continue
+            measure, offset = corridor.project(track.lat, track.lon)
+            keep = np.flatnonzero((offset <= self.max_offset) & np.isfinite(track.time))
+            if len(keep) < 2:
+                continue
+            m = measure[keep]
+            t = track.time[keep]
+            s = signal_measure[None, :]
+            chunk_size = max(1, chunk_cells // len(signal_ids))
+            for start in range(0, len(m) - 1, chunk_size):
+                stop = min(start + chunk_size, len(m) - 1)
+                m0, m1 = m[start:stop, None], m[start + 1:stop + 1, None]
+                t0, t1 = t[start:stop, None], t[start + 1:stop + 1, None]
+
+                # a signal is crossed between two consecutive on-corridor points when it lies between their references
+                crossed = ((m0 < s) & (s <= m1)) | ((m1 <= s) & (s < m0))
+                crossed &= (t1 - t0) <= self.max_gap
+                pair, k = np.nonzero(crossed)
+                pair += start
+                fraction = (signal_measure[k] - m[pair]) / (m[pair + 1] - m[pair])
+                times.append(t[pair] + fraction * (t[pair + 1] - t[pair]))
+                signals.append(signal_ids[k])
+
+        if not times:
+            return np.array([], dtype=np.float64), np.array([], dtype=np.int64)
+        times = np.concatenate(times)
+        signals = np.concatenate(signals)
+        order = np.argsort(times, kind='stable')
+        times, signals = times[order], signals[order]
+
+        last_of_run = np.ones(len(signals), dtype=bool)
+        last_of_run[:-1] = signals[:-1] != signals[1:]
+        return times[last_of_run], signals[last_of_run]
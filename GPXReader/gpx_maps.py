@@ -0,0 +1,119 @@
+# Batched folium rendering of GPX points coloured by speed category (gpx_observations and OneWayFlagging)
+# Instead of one folium.CircleMarker per point (one Leaflet layer and one popup per point in the HTML), the points
+# are drawn either as one polyline layer per speed category or as a single GeoJSON point layer on a canvas
+# renderer, optionally thinned to one point per grid cell, so maps of full-day traces stay small and responsive.
+
+import folium
+import numpy as np
+import pandas as pd
+
+from gpx_tracks import EARTH_RADIUS_M, haversine
+
+# Define color for each speed category
+SPEED_COLORS = {
+    'Below 3 mph': 'red',
+    '3-15 mph': 'orange',
+    '15-30 mph': 'yellow',
+    'Above 30 mph': 'green'
+}
+
+# 'lines'   - consecutive points of the same speed category joined into polylines, one layer per category
+# 'geojson' - every point as a circle in one GeoJSON layer (time and speed in a popup)
+# 'markers' - one CircleMarker per point (the original rendering; slow for long traces)
+MAP_MODES = ('lines', 'geojson', 'markers')
+
+
+# Function to create the base map (canvas rendering keeps large point and line layers responsive)
+def base_map(df, mode='lines'):
+    return folium.Map(tiles="cartodb positron", location=[df['Latitude'].mean(), df['Longitude'].mean()], zoom_start=12,
+                      prefer_canvas=mode != 'markers')
+
+
+# Function to keep the first point of each speed category in every cell_m x cell_m grid cell (order is kept)
+def decimate_points(df, cell_m):
+    lat = df['Latitude'].to_numpy(dtype=np.float64)
+    lon = df['Longitude'].to_numpy(dtype=np.float64)
+    cell_lat = np.degrees(cell_m / EARTH_RADIUS_M)
+    cell_lon = cell_lat / max(np.cos(np.radians(np.nanmean(lat))), 1e-6)
+    cells = pd.DataFrame({'row': np.floor(lat / cell_lat), 'col': np.floor(lon / cell_lon),
+                          'category': df['SpeedCategory'].to_numpy()})
+    return df[~cells.duplicated().to_numpy()]
+
+
+# Function to split a trace into runs of consecutive points with the same speed category
+# A run is also broken where consecutive points are more than max_gap_m apart (a new GPX file or a logging gap).
+# Each run ends on the first point of the next run when that run follows directly, so the line has no holes.
+# A point cut off by gaps on both sides (or a last point with its own category) is a run of one point.
+# Returns {category: [[[lat, lon], ...], ...]}
+def speed_runs(df, max_gap_m=500):
+    lat = df['Latitude'].to_numpy(dtype=np.float64)
+    lon = df['Longitude'].to_numpy(dtype=np.float64)
+    category = df['SpeedCategory'].astype(object).to_numpy()
+
+    gap = haversine(lat[:-1], lon[:-1], lat[1:], lon[1:]) > max_gap_m
+    breaks = np.flatnonzero((category[1:] != category[:-1]) | gap) + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.append(breaks + ~gap[breaks - 1], len(df))
+
+    coordinates = np.column_stack([lat, lon]).round(6).tolist()
+    runs = {name: [] for name in SPEED_COLORS}
+    for start, end, name in zip(starts, ends, category[starts] if len(df) else []):
+        if name in runs:
+            runs[name].append(coordinates[start:end])
+    return runs
+
+
+# Function to add the GPX points of df (Latitude, Longitude, SpeedCategory, TimeOfDay, Speed) to a map
+# decimate_m thins the points to one per speed category in every decimate_m meter grid cell first (None keeps all)
+def add_speed_points(m, df, mode='lines', decimate_m=None, max_gap_m=500):
+    if mode not in MAP_MODES:
+        raise ValueError(f"Unknown map mode {mode!r} (expected one of {', '.join(MAP_MODES)})")
+    if decimate_m:
+        df = decimate_points(df, decimate_m)
+
+    if mode == 'lines':
+        for name, runs in speed_runs(df, max_gap_m).items():
+            if runs:
+                layer = folium.FeatureGroup(name=name)
+                lines = [run for run in runs if len(run) > 1]
+                if lines:
+                    folium.PolyLine(lines, color=SPEED_COLORS[name], weight=5, opacity=0.8, tooltip=name).add_to(layer)
+                # Runs of a single point have no line to draw, so they are shown as dots
+                for run in runs:
+                    if len(run) == 1:
+                        folium.CircleMarker(location=run[0], radius=3, color=SPEED_COLORS[name], fill=True,
+                                            fill_opacity=0.8, tooltip=name).add_to(layer)
+                layer.add_to(m)
+        folium.LayerControl().add_to(m)
+
+    elif mode == 'geojson':
+        category = df['SpeedCategory'].astype(object).to_numpy()
+        features = [
+            {'type': 'Feature',
+             'geometry': {'type': 'Point', 'coordinates': [round(lon, 6), round(lat, 6)]},
+             'properties': {'color': SPEED_COLORS[name], 'Time': time_of_day, 'Speed': round(speed, 2)}}
+            for lat, lon, name, time_of_day, speed in zip(df['Latitude'].tolist(), df['Longitude'].tolist(), category,
+                                                           df['TimeOfDay'].tolist(), df['Speed'].tolist())
+            if name in SPEED_COLORS]
+        folium.GeoJson(
+            {'type': 'FeatureCollection', 'features': features},
+            name='Speed from GPX Data',
+            marker=folium.CircleMarker(radius=5, fill=True, fill_opacity=0.7),
+            style_function=lambda feature: {'color': feature['properties']['color'], 'fillColor': feature['properties']['color']},
+            popup=folium.GeoJsonPopup(fields=['Time', 'Speed'])
+        ).add_to(m)
+
+    else:
+        # Add points to the map
+        for _, row in df.iterrows():
+            folium.CircleMarker(
+                location=[row['Latitude'], row['Longitude']],
+                radius=5,
+                color=SPEED_COLORS[row['SpeedCategory']],
+                # fill=True,
+                fill_color= SPEED_COLORS[row['SpeedCategory']], #'RdYlGn',
+                fill_opacity=0.7,
+                legend_name = 'Speed from GPX Data',
+                popup=f"Time: {row['TimeOfDay']}<br>Speed: {row['Speed']} mph<br>Lat: {row['Latitude']}<br>Lon: {row['Longitude']}"
+            ).add_to(m)
+    return m
@@ -7,8 +7,6 @@ import os
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
-import xml.etree.ElementTree as ET
-from datetime import datetime
 import geopandas as gpd
 import numpy as np
 import mplcursors
@@ -16,6 +14,8 @@ import plotly.express as px
 import plotly.graph_objects as go
 import pytz
 import folium
+from gpx_tracks import Track, MPS_TO_MPH
+from gpx_maps import base_map, add_speed_points
 
 # Define Salt Lake City's timezone
 LOCAL_TZ = pytz.timezone('America/Denver')
@@ -23,43 +23,16 @@ LOCAL_TZ = pytz.timezone('America/Denver')
 
 # Function to parse GPX file and calculate speed
 def parse_gpx(file_path):
-    tree = ET.parse(file_path)
-    root = tree.getroot()
+    track = Track.from_gpx(file_path)
 
-    namespaces = {
-        'gpx': 'http://www.topografix.com/GPX/1/1'
-    }
-    
-    data = []
-    previous_point = None
-    previous_time = None
-    
-    for trkpt in root.findall('.//gpx:trkpt', namespaces):
-        timestamp = trkpt.find('gpx:time', namespaces).text
-        lat = float(trkpt.get('lat'))
-        lon = float(trkpt.get('lon'))
-        
-        # Handle different timestamp formats
-        try:
-            time_of_day_utc = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ')
-        except ValueError:
-            time_of_day_utc = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ')
-        
-        # Convert UTC time to local time
-        time_of_day_local = time_of_day_utc.replace(tzinfo=pytz.utc).astimezone(LOCAL_TZ)
-        
-        if previous_point is not None and previous_time is not None:
-            distance = haversine(previous_point[0], previous_point[1], lat, lon)
-            time_diff = (time_of_day_local - previous_time).total_seconds() / 3600.0  # time difference in hours
-            speed = distance / time_diff if time_diff != 0 else 0
-        else:
-            speed = 0.0
-        
-        data.append([time_of_day_local.strftime('%H:%M:%S'), lat, lon, speed])
-        previous_point = (lat, lon)
-        previous_time = time_of_day_local
-    
-    df = pd.DataFrame(data, columns=['TimeOfDay', 'Latitude', 'Longitude', 'Speed'])
+    # Convert UTC time to local time for the whole track at once
+    local_time = track.local_times(LOCAL_TZ)
+
+    df = pd.DataFrame({
+        'TimeOfDay': local_time.strftime('%H:%M:%S'),
+        'Latitude': track.lat,
+        'Longitude': track.lon,
+        'Speed': track.speeds() * MPS_TO_MPH})  # mph
 
     bins = [-float('inf'), 3, 15, 30, float('inf')]
     labels = ['Below 3 mph', '3-15 mph', '15-30 mph', 'Above 30 mph']
@@ -94,23 +67,29 @@ def parse_kml(file_path):
     key_intersections['Intersection'] = range(len(key_intersections))
     return key_intersections
 
+# Function to find the nearest intersection (its 'Intersection' number) for arrays of points
+def nearest_intersections(lat, lon, key_intersections, chunk_cells=4_000_000):
+    intersection_lat = key_intersections['Latitude'].to_numpy(dtype=float)
+    intersection_lon = key_intersections['Longitude'].to_numpy(dtype=float)
+    intersection_ids = key_intersections['Intersection'].to_numpy()
+
+    nearest = np.empty(len(lat), dtype=np.int64)
+    chunk_size = max(1, chunk_cells // max(1, len(intersection_lat)))
+    for start in range(0, len(lat), chunk_size):
+        stop = start + chunk_size
+        distances = haversine(lat[start:stop, None], lon[start:stop, None], intersection_lat[None, :], intersection_lon[None, :])
+        nearest[start:stop] = np.argmin(distances, axis=1)  # ties go to the first intersection, as before
+    return intersection_ids[nearest]
+
 # Function to map lat/lon to intersections
 def map_to_intersections(df, key_intersections, direction):
     # Create dictionaries to map intersection names to latitude and longitude values
     intersection_to_lat = key_intersections.set_index('Name')['Latitude'].to_dict()
     intersection_to_lon = key_intersections.set_index('Name')['Longitude'].to_dict()
 
-    def get_nearest_intersection(lat, lon):
-        min_distance = float('inf')
-        nearest_intersection = None
-        for _, row in key_intersections.iterrows():
-            dist = haversine(lat, lon, row.geometry.y, row.geometry.x)
-            if dist < min_distance:
-                min_distance = dist
-                nearest_intersection = row['Intersection']
-        return nearest_intersection
-    
-    df['Intersection'] = df.apply(lambda row: get_nearest_intersection(row['Latitude'], row['Longitude']), axis=1)
+    # Find the nearest intersection for every point with a broadcast (points x intersections) distance matrix,
+    # built in chunks so memory stays bounded for very large inputs
+    df['Intersection'] = nearest_intersections(df['Latitude'].to_numpy(), df['Longitude'].to_numpy(), key_intersections)
     df = df.merge(key_intersections[['Intersection', 'Name']], on='Intersection', how='left')
 
     # Map intersection names to latitudes and longitudes
@@ -160,30 +139,13 @@ def make_time_plot(data, intersection_coords, direction):
     fig.show()
 
 # Function to plot data on a map
-def plot_data_on_map(df):
+# mode is one of gpx_maps.MAP_MODES ('lines', 'geojson' or 'markers'); decimate_m thins the points to one per grid cell
+def plot_data_on_map(df, mode='lines', decimate_m=None):
     # Create a base map
-    m = folium.Map(tiles="cartodb positron", location=[df['Latitude'].mean(), df['Longitude'].mean()], zoom_start=12)
-    
-    # Define color for each speed category
-    colors = {
-        'Below 3 mph': 'red',
-        '3-15 mph': 'orange',
-        '15-30 mph': 'yellow',
-        'Above 30 mph': 'green'
-    }
-
-    # Add points to the map
-    for _, row in df.iterrows():
-        folium.CircleMarker(
-            location=[row['Latitude'], row['Longitude']],
-            radius=5,
-            color=colors[row['SpeedCategory']],
-            # fill=True,
-            fill_color= colors[row['SpeedCategory']], #'RdYlGn',
-            fill_opacity=0.7,
-            legend_name = 'Speed from GPX Data',
-            popup=f"Time: {row['TimeOfDay']}<br>Speed: {row['Speed']} mph<br>Lat: {row['Latitude']}<br>Lon: {row['Longitude']}"
-        ).add_to(m)
+    m = base_map(df, mode)
+
+    # Add points to the map, batched by speed category
+    add_speed_points(m, df, mode, decimate_m)
     
     # Define the output file name
     map_output = 'gpx_map.html'
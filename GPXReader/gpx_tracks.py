@@ -0,0 +1,287 @@
+# Shared columnar representation of GPX tracks for the GPXReader scripts (and OneWayFlagging)
+# A Track holds lat, lon, epoch seconds (UTC) and elevation as contiguous float64 arrays so
+# point-to-point distance, speed, bearing and grade are whole-array operations instead of
+# per-point dicts, math-module haversine and strftime/strptime round trips.
+
+import hashlib
+import math
+import os
+import tempfile
+import xml.etree.ElementTree as ET
+import zipfile
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_M = 6371000  # Radius of Earth in meters
+MPS_TO_MPH = 2.23694  # meters per second to miles per hour
+GPX_BATCH_SIZE = 65536  # trackpoints converted to arrays at a time by the streaming parser
+
+# Parsed tracks are cached on disk as .npz arrays keyed by the GPX file's content hash and the parser version,
+# so re-running a study over the same GPX folder skips XML parsing entirely.
+# Bump PARSER_VERSION whenever iter_gpx_batches changes what it produces; set GPX_CACHE_DIR to move the cache
+# (or to an empty string to turn it off).
+PARSER_VERSION = 2
+GPX_CACHE_DIR = os.environ.get('GPX_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'avenue-tools', 'gpx'))
+
+
+# Vectorized Haversine distance (meters) between two points or arrays of points
+def haversine(lat1, lon1, lat2, lon2):
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    delta_phi = np.radians(np.subtract(lat2, lat1))
+    delta_lambda = np.radians(np.subtract(lon2, lon1))
+    a = np.sin(delta_phi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(delta_lambda / 2) ** 2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return EARTH_RADIUS_M * c
+
+
+# Vectorized initial compass bearing (degrees, 0-360) from point 1 to point 2
+def bearing(lat1, lon1, lat2, lon2):
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    delta_lambda = np.radians(np.subtract(lon2, lon1))
+    x = np.sin(delta_lambda) * np.cos(phi2)
+    y = np.cos(phi1) * np.sin(phi2) - np.sin(phi1) * np.cos(phi2) * np.cos(delta_lambda)
+    return (np.degrees(np.arctan2(x, y)) + 360) % 360
+
+
+@dataclass
+class Track:
+    """GPX trackpoints as parallel float64 arrays (time is UTC epoch seconds, elevation is NaN when missing)."""
+    lat: np.ndarray
+    lon: np.ndarray
+    time: np.ndarray
+    elevation: np.ndarray
+
+    def __post_init__(self):
+        self.lat = np.ascontiguousarray(self.lat, dtype=np.float64)
+        self.lon = np.ascontiguousarray(self.lon, dtype=np.float64)
+        self.time = np.ascontiguousarray(self.time, dtype=np.float64)
+        self.elevation = np.ascontiguousarray(self.elevation, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.lat)
+
+    @classmethod
+    def from_gpx(cls, gpx_file, cache_dir=None):
+        """Read every trackpoint of every track/segment in a GPX file, using the parsed-track cache when possible.
+
+        cache_dir defaults to GPX_CACHE_DIR; an empty string skips the cache.
+        """
+        if cache_dir is None:
+            cache_dir = GPX_CACHE_DIR
+        if not cache_dir:
+            return cls.concat(iter_gpx_batches(gpx_file))
+
+        cache_file = os.path.join(cache_dir, f"{file_digest(gpx_file)}-v{PARSER_VERSION}.npz")
+        try:
+            with np.load(cache_file, allow_pickle=False) as cached:
+                return cls(cached['lat'], cached['lon'], cached['time'], cached['elevation'])
+        except (OSError, KeyError, ValueError, zipfile.BadZipFile):
+            pass  # not cached yet (or unreadable or corrupt), parse the XML
+
+        track = cls.concat(iter_gpx_batches(gpx_file))
+        track.save(cache_file)
+        return track
+
+    def save(self, path):
+        """Write the arrays to an .npz file (written to a temporary file first so parallel readers never see half a file)."""
+        tmp_path = None
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.npz')
+            with os.fdopen(fd, 'wb') as file:
+                np.savez(file, lat=self.lat, lon=self.lon, time=self.time, elevation=self.elevation)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Could not cache parsed track to {path}: {e}")
+        finally:
+            if tmp_path is not None and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    @classmethod
+    def concat(cls, tracks):
+        """Join several tracks end to end (in the order given)."""
+        tracks = list(tracks)
+        if not tracks:
+            return cls([], [], [], [])
+        return cls(np.concatenate([t.lat for t in tracks]),
+                   np.concatenate([t.lon for t in tracks]),
+                   np.concatenate([t.time for t in tracks]),
+                   np.concatenate([t.elevation for t in tracks]))
+
+    def epoch_seconds(self):
+        """Whole UTC epoch seconds (int64), truncated like the second-resolution time stamps the scripts report."""
+        return np.floor(self.time).astype(np.int64)
+
+    def local_times(self, tz):
+        """Trackpoint times as a timezone-aware DatetimeIndex in `tz`, converted for the whole track at once."""
+        return pd.to_datetime(self.time, unit='s', utc=True).tz_convert(tz)
+
+    def distances(self):
+        """Distance (m) from the previous point; 0 for the first point."""
+        d = np.zeros(len(self))
+        d[1:] = haversine(self.lat[:-1], self.lon[:-1], self.lat[1:], self.lon[1:])
+        return d
+
+    def time_deltas(self):
+        """Seconds since the previous point; 0 for the first point."""
+        dt = np.zeros(len(self))
+        dt[1:] = np.diff(self.time)
+        return dt
+
+    def speeds(self):
+        """Speed (m/s) from the previous point; 0 for the first point and for repeated timestamps."""
+        d = self.distances()
+        dt = self.time_deltas()
+        return np.divide(d, dt, out=np.zeros(len(self)), where=dt != 0)
+
+    def bearings(self):
+        """Compass bearing (degrees) from the previous point; NaN for the first point."""
+        b = np.full(len(self), np.nan)
+        b[1:] = bearing(self.lat[:-1], self.lon[:-1], self.lat[1:], self.lon[1:])
+        return b
+
+    def grades(self):
+        """Grade (%) from the previous point; 0 for the first point and where no distance was covered."""
+        d = self.distances()
+        rise = np.zeros(len(self))
+        rise[1:] = np.diff(self.elevation)
+        return np.divide(rise, d, out=np.zeros(len(self)), where=d != 0) * 100
+
+    def cumulative_distances(self):
+        """Distance (m) travelled from the first point."""
+        return np.cumsum(self.distances())
+
+
+# Convert UTC epoch seconds to naive local wall-clock datetime64 values in one vectorized operation
+# (naive so they can be written straight to Excel; format them as strings only when exporting)
+def local_datetimes(epoch_seconds, tz):
+    return pd.to_datetime(epoch_seconds, unit='s', utc=True).tz_convert(tz).tz_localize(None)
+
+
+# SHA-256 of a file's contents (the parsed-track cache key)
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Local tag name without the GPX 1.0/1.1 namespace
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+# Stream the trackpoints of a GPX file as Tracks of at most `batch_size` points.
+# The file is read with iterparse and every trackpoint is cleared (and dropped from its segment) once its
+# lat/lon/time/ele are read, so memory stays bounded by the batch size however long the log is.
+# Trackpoints without a <time> are skipped: speeds and travel times need a time stamp on every point.
+def iter_gpx_batches(gpx_file, batch_size=GPX_BATCH_SIZE):
+    lat, lon, time, elevation = [], [], [], []
+    segment = None
+
+    def flush():
+        # Times are ISO 8601 (with or without fractional seconds)
+        times = pd.to_datetime(pd.Series(time, dtype=object), utc=True, format='ISO8601')
+        epoch = times.to_numpy(dtype='datetime64[ns]').astype(np.int64) / 1e9
+        batch = Track(np.array(lat, dtype=np.float64), np.array(lon, dtype=np.float64),
+                      epoch, np.array(elevation, dtype=np.float64))
+        lat.clear(), lon.clear(), time.clear(), elevation.clear()
+        return batch
+
+    for event, elem in ET.iterparse(gpx_file, events=('start', 'end')):
+        name = _local_name(elem.tag)
+        if event == 'start':
+            if name == 'trkseg':
+                segment = elem
+            continue
+        if name != 'trkpt':
+            continue
+
+        point_time = point_elevation = None
+        for child in elem:
+            child_name = _local_name(child.tag)
+            if child_name == 'time':
+                point_time = child.text
+            elif child_name == 'ele':
+                point_elevation = child.text
+        if point_time and point_time.strip():
+            lat.append(elem.get('lat'))
+            lon.append(elem.get('lon'))
+            time.append(point_time.strip())
+            elevation.append(point_elevation if point_elevation else np.nan)
+
+        # Free the parsed trackpoint (the segment only ever holds the point being read)
+        elem.clear()
+        if segment is not None:
+            del segment[:]
+
+        if len(lat) >= batch_size:
+            yield flush()
+
+    if lat:
+        yield flush()
+
+
+# Spatial index over the significant intersections so each GPX point only tests the few
+# intersections in its neighbourhood instead of the whole corridor.
+# Intersections are bucketed into a lat/lon grid whose cells are at least `radius` meters on a side,
+# so every intersection within `radius` of a point is in the point's cell or one of its 8 neighbours.
+class IntersectionIndex:
+    def __init__(self, intersections, radius):
+        self.intersections = intersections
+        self.radius = radius
+        self.lat = np.array([intersection['lat'] for intersection in intersections], dtype=np.float64)
+        self.lon = np.array([intersection['lon'] for intersection in intersections], dtype=np.float64)
+        max_lat = float(np.abs(self.lat).max()) if len(self.lat) else 0.0
+        # pad the cells by 1% so rounding in the small-angle approximation can never drop a candidate
+        self.lat_step = math.degrees(radius / EARTH_RADIUS_M) * 1.01
+        self.lon_step = math.degrees(radius / (EARTH_RADIUS_M * math.cos(math.radians(min(max_lat + self.lat_step, 89.0))))) * 1.01
+        self.rows = np.floor(self.lat / self.lat_step).astype(np.int64)
+        self.cols = np.floor(self.lon / self.lon_step).astype(np.int64)
+
+    @staticmethod
+    def _key(rows, cols):
+        return rows * (1 << 32) + cols
+
+    def match(self, lat, lon):
+        """Index of the first intersection (in file order) within `radius` of each point, -1 where there is none."""
+        lat = np.asarray(lat, dtype=np.float64)
+        lon = np.asarray(lon, dtype=np.float64)
+        matches = np.full(len(lat), -1, dtype=np.int64)
+        if len(lat) == 0 or len(self.lat) == 0:
+            return matches
+
+        # sort the points by grid cell so each intersection finds its neighbourhood with a binary search
+        keys = self._key(np.floor(lat / self.lat_step).astype(np.int64), np.floor(lon / self.lon_step).astype(np.int64))
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        offsets = np.array([-1, 0, 1], dtype=np.int64)
+
+        # walk the intersections in file order so a point keeps the first intersection it falls within
+        for i in range(len(self.lat)):
+            cell_keys = self._key(np.repeat(self.rows[i] + offsets, 3), np.tile(self.cols[i] + offsets, 3))
+            lo = np.searchsorted(sorted_keys, cell_keys, side='left')
+            hi = np.searchsorted(sorted_keys, cell_keys, side='right')
+            near = np.concatenate([order[a:b] for a, b in zip(lo, hi)])
+            near = near[matches[near] < 0]
+            if near.size:
+                distance = haversine(lat[near], lon[near], self.lat[i], self.lon[i])
+                matches[near[distance <= self.radius]] = i
+        return matches
+
+
+# Pair up consecutive intersection hits along a track (as returned by IntersectionIndex.match).
+# Returns (prev_point, start_point, point, prev_intersection, intersection) arrays with one entry per pair.
+# The travel-time scripts stamp each intersection with the time of its latest hit, so when the same
+# intersection is hit twice in a row the segment is timed from the later hit (start_point == point).
+def hit_pairs(matches):
+    hits = np.flatnonzero(matches >= 0)
+    prev_point, point = hits[:-1], hits[1:]
+    prev_intersection, intersection = matches[prev_point], matches[point]
+    start_point = np.where(prev_intersection == intersection, point, prev_point)
+    return prev_point, start_point, point, prev_intersection, intersection
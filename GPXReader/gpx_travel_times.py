@@ -5,15 +5,19 @@
 # this script will read in gpx files and a significant intersection file (csv or kml) and find travel times on segments between significant intersections
 
 import os
-import gpxpy
 import csv
-import math
+import numpy as np
 import pandas as pd
-from datetime import datetime
 from fastkml import kml
 import zipfile
 import sys 
 import pytz
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from gpx_tracks import Track, IntersectionIndex, hit_pairs, local_datetimes, file_digest
+from gpx_incremental import IncrementalStore
+from gpx_map_matching import CorridorMatcher
 
 # Define Salt Lake City's timezone
 LOCAL_TZ = pytz.timezone('America/Denver')
@@ -40,118 +44,213 @@ def convert_kmz_to_kml(kmz_file):
                 return os.path.join(os.path.dirname(kmz_file), file_name)
     return None
 
-# function to parse KML file containing significant intersection information
+# function to walk the placemarks (with geometry) of a KML file
 # ------------------
-def parse_kml(kml_file):
-    intersections = []
-    
+def kml_placemarks(kml_file):
     with open(kml_file, 'rb') as file:
         doc = file.read()
         k = kml.KML()
         k.from_string(doc)
-        
-        # Assuming the KML has a single document
-        for document in k.features():
-            for folder in document.features():
-                for feature in folder.features():
-                    if isinstance(feature, kml.Placemark):
-                        geometry = feature.geometry
-                        if geometry:
-                            if geometry.geom_type == 'Point':
-                                coordinates = list(geometry.coords)[0]
-                                intersections.append({
-                                    'route_id': feature.name,
-                                    'segment_id': feature.name,
-                                    #'description': feature.description if feature.description else '',
-                                    'lat': coordinates[1],
-                                    'lon': coordinates[0]
-                                })
+
+    # Assuming the KML has a single document
+    for document in k.features():
+        for folder in document.features():
+            for feature in folder.features():
+                if isinstance(feature, kml.Placemark) and feature.geometry:
+                    yield feature
+
+# function to parse KML file containing significant intersection information (Point placemarks)
+def parse_kml(kml_file):
+    intersections = []
+    for feature in kml_placemarks(kml_file):
+        if feature.geometry.geom_type == 'Point':
+            coordinates = list(feature.geometry.coords)[0]
+            intersections.append({
+                'route_id': feature.name,
+                'segment_id': feature.name,
+                #'description': feature.description if feature.description else '',
+                'lat': coordinates[1],
+                'lon': coordinates[0]
+            })
     return intersections
-#-------------------
 
-# Function to calculate distance between two points using Haversine formula
-def haversine(lat1, lon1, lat2, lon2):
-    # Haversine formula implementation
-    R = 6371000  # Radius of Earth in meters
-    phi1 = math.radians(lat1)
-    phi2 = math.radians(lat2)
-    delta_phi = math.radians(lat2 - lat1)
-    delta_lambda = math.radians(lon2 - lon1)
-    a = math.sin(delta_phi/2) * math.sin(delta_phi/2) + \
-        math.cos(phi1) * math.cos(phi2) * \
-        math.sin(delta_lambda/2) * math.sin(delta_lambda/2)
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1-a))
-    distance = R * c
-    return distance
-
-# Function to calculate travel time between two timestamps
-def calculate_travel_time(start_time, end_time):
-    start_datetime = datetime.strptime(start_time, '%Y-%m-%dT%H:%M:%S')
-    end_datetime = datetime.strptime(end_time, '%Y-%m-%dT%H:%M:%S')
-    return (end_datetime - start_datetime).total_seconds()
+# function to parse the corridor geometry (LineString placemarks) from the same KML file
+def parse_kml_corridors(kml_file):
+    corridors = []
+    for feature in kml_placemarks(kml_file):
+        if feature.geometry.geom_type == 'LineString':
+            coordinates = list(feature.geometry.coords)
+            corridors.append({
+                'name': feature.name,
+                'lat': [coord[1] for coord in coordinates],
+                'lon': [coord[0] for coord in coordinates]
+            })
+    return corridors
+#-------------------
 
 # Function to parse GPX file and calculate travel times
-def parse_gpx_file(gpx_file, intersections):
-    gpx_data = []
-    # Parse the GPX file
-    with open(gpx_file, 'r') as gpx_file:
-        gpx = gpxpy.parse(gpx_file)
-        # Extract data from GPX
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    # Convert UTC time to local time
-                    local_time = point.time.replace(tzinfo=pytz.UTC).astimezone(LOCAL_TZ)
-                    gpx_data.append({
-                        'lat': point.latitude, 
-                        'lon': point.longitude, 
-                        'time': local_time.strftime('%Y-%m-%dT%H:%M:%S')
-                        })
-
-    # Initialize variables
-    output_data = []  # Initialize output data list
-    prev_intersection = None  # Initialize previous intersection
-
-    # Iterate through each point in GPX data
-    for point in gpx_data:
-        closest_intersection = None
-        # Iterate through each significant intersection
-        for intersection in intersections:
-            # Calculate the distance between the current point and the intersection
-            distance = haversine(point['lat'], point['lon'], intersection['lat'], intersection['lon'])
-            # Check if the distance is within the threshold (50 feet)
-            if distance <= 30:  # 100 feet in meters
-                closest_intersection = intersection
-                # Assign the time of the current point to the closest intersection
-                closest_intersection['time'] = point['time']
-                break  # Exit the loop if a significant intersection is found within the threshold
-
-        # If a closest intersection is found within the threshold, process it
-        if closest_intersection:
-            if prev_intersection:
-                # Calculate travel time between the previous intersection and the current closest intersection
-                travel_time = calculate_travel_time(prev_intersection['time'], point['time'])
-                # Store the segment start, segment finish, and travel time in the output data
-                output_data.append({
-                    'route_ID': prev_intersection['route_id'] + ' / ' + closest_intersection['route_id'], 
-                    'segment_start': prev_intersection['segment_id'], 
-                    'segment_finish': closest_intersection['segment_id'], 
-                    'travel_time': travel_time, 
-                    'start_time': prev_intersection['time'], 
-                    'end_time': closest_intersection['time']})
-            prev_intersection = closest_intersection
-
-    # Convert output data to DataFrame
-    output_df = pd.DataFrame(output_data)
+# With a CorridorMatcher the trace is snapped to the KML corridor and signal crossing times are interpolated;
+# otherwise a signal is hit when a trackpoint falls within 30 m of it
+def parse_gpx_file(gpx_file, intersections, index=None, matcher=None):
+    # Parse the GPX file into columnar arrays
+    track = Track.from_gpx(gpx_file)
+    if matcher is not None:
+        return corridor_segments(track, intersections, matcher)
+
+    # Build the spatial index once per corridor (pass it in when processing many files)
+    if index is None:
+        index = IntersectionIndex(intersections, 30)
+
+    # Find the first significant intersection within 30 m (100 feet) of every point, then pair consecutive hits
+    matches = index.match(track.lat, track.lon)
+    _, start_point, point, prev_intersection, intersection = hit_pairs(matches)
+
+    # Whole-second epoch times for the segment ends; travel time is integer arithmetic on these
+    seconds = track.epoch_seconds()
+    start_seconds = seconds[start_point]
+    end_seconds = seconds[point]
+    route_ids = np.array([i['route_id'] for i in intersections], dtype=object)
+    segment_ids = np.array([i['segment_id'] for i in intersections], dtype=object)
+
+    # Store the segment start, segment finish, and travel time in the output data
+    output_df = pd.DataFrame({
+        'route_ID': route_ids[prev_intersection] + ' / ' + route_ids[intersection],
+        'segment_start': segment_ids[prev_intersection],
+        'segment_finish': segment_ids[intersection],
+        'travel_time': (end_seconds - start_seconds).astype(np.float64),
+        'start_time': local_datetimes(start_seconds, LOCAL_TZ),
+        'end_time': local_datetimes(end_seconds, LOCAL_TZ)})
+    return output_df
+
+# Function to build the travel time table from interpolated corridor crossings (sub-second times)
+def corridor_segments(track, intersections, matcher):
+    times, crossed = matcher.crossings(track)
+    route_ids = np.array([i['route_id'] for i in intersections], dtype=object)
+    segment_ids = np.array([i['segment_id'] for i in intersections], dtype=object)
+
+    # Each pair of consecutive crossings is a segment
+    output_df = pd.DataFrame({
+        'route_ID': route_ids[crossed[:-1]] + ' / ' + route_ids[crossed[1:]],
+        'segment_start': segment_ids[crossed[:-1]],
+        'segment_finish': segment_ids[crossed[1:]],
+        'travel_time': np.diff(times),
+        'start_time': local_datetimes(times[:-1], LOCAL_TZ),
+        'end_time': local_datetimes(times[1:], LOCAL_TZ)})
     return output_df
 
+# Function to process one GPX file for the batch. Errors are returned instead of raised
+# so a single bad file is reported without aborting the rest of the folder
+def process_gpx_file(gpx_file, intersections, index, matcher=None):
+    try:
+        result = parse_gpx_file(gpx_file, intersections, index, matcher)
+        result['route'] = os.path.splitext(os.path.basename(gpx_file))[0]  # Extract route name from filename
+        return result, None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+# Function to calculate travel times for every GPX file in a folder, optionally across a pool of processes.
+# Files are processed in sorted filename order and results come back in that same order for any worker count.
+# workers=1 runs serially, workers=0 uses one process per CPU core. Pass a CorridorMatcher to use corridor matching.
+def process_gpx_folder(folder_path, intersections, workers=1, matcher=None):
+    processed, failures = process_gpx_files(list_gpx_files(folder_path), intersections, workers, matcher)
+    return [result for _, result in processed], failures
+
+# Function to list the GPX files of a folder in filename order
+def list_gpx_files(folder_path):
+    return [os.path.join(folder_path, filename) for filename in sorted(os.listdir(folder_path)) if filename.endswith('.gpx')]
+
+# Function to process a list of GPX files, returning (gpx_file, result) pairs in the same order plus the failures
+def process_gpx_files(gpx_files, intersections, workers=1, matcher=None):
+    # Build the intersection index once and share it across every GPX file
+    index = IntersectionIndex(intersections, 30)
+
+    if workers == 1 or len(gpx_files) <= 1:
+        outcomes = [process_gpx_file(gpx_file, intersections, index, matcher) for gpx_file in gpx_files]
+    else:
+        with ProcessPoolExecutor(max_workers=workers or None) as executor:
+            outcomes = list(executor.map(process_gpx_file, gpx_files, repeat(intersections), repeat(index), repeat(matcher)))
+
+    processed = []
+    failures = []
+    for gpx_file, (result, error) in zip(gpx_files, outcomes):
+        if error is None:
+            processed.append((gpx_file, result))
+        else:
+            print(f"Failed to process {os.path.basename(gpx_file)}: {error}")
+            failures.append((gpx_file, error))
+    print(f"Processed {len(processed)} of {len(gpx_files)} GPX files ({len(failures)} failed).")
+    return processed, failures
+
+# Function to refresh the incremental store: only new or modified GPX files are processed, and the stored
+# results of every file still in the folder are returned
+def process_gpx_folder_incremental(folder_path, intersections, store, workers=1, matcher=None):
+    gpx_files = list_gpx_files(folder_path)
+    pending = store.pending(gpx_files)
+    print(f"{len(gpx_files) - len(pending)} GPX files unchanged since the last run, {len(pending)} new or modified.")
+    processed, failures = process_gpx_files(pending, intersections, workers, matcher)
+    for gpx_file, result in processed:
+        store.update(gpx_file, result)
+    # Failed files are dropped from the manifest (with any outdated result from before they changed),
+    # so they are left out of the workbook and retried next time
+    for gpx_file, _ in failures:
+        store.discard(gpx_file)
+    store.save()
+    return store.results(), failures
+
+# Function to build the segment table (sheet one) and the 15-minute travel time pivot (sheet two) from the results
+def build_tables(final_result):
+    # Format into table
+    # Step 1: Filter out rows where segment_start equals segment_finish
+    filtered_df = final_result[final_result['segment_start'] != final_result['segment_finish']].copy()
+    filtered_df.loc[:,'route'] = filtered_df['segment_start'] + '_to_' + filtered_df['segment_finish']
+    # Add a new column indicating the order of occurrence for each combination
+    filtered_df['run_number'] = filtered_df.groupby('route').cumcount() + 1
+
+    # Get the earliest and latest hours
+    earliest_hour = filtered_df['start_time'].min().floor('h')
+    latest_hour = filtered_df['start_time'].max().ceil('h')
+
+    # Create 15-minute bins
+    time_bins = pd.date_range(start=earliest_hour, end=latest_hour, freq='15min')
+
+    # Create unique labels for the bins (as strings)
+    time_labels = time_bins[:-1].strftime('%Y-%m-%d %H:%M')
+
+    # Assign each row to a time bin
+    filtered_df['time_bin'] = pd.cut(filtered_df['start_time'], bins=time_bins, labels=time_labels, include_lowest=True)
+
+    # Pivot the table based on the new column 'time_bin'
+    pivoted_df = filtered_df.pivot_table(index=['route_ID', 'route'], columns='time_bin', values='travel_time', aggfunc='first')
+
+    # Calculate the average travel time across time bins
+    pivoted_df['average'] = pivoted_df.mean(axis=1)
+
+    # Calculate the standard deviation of travel times across time bins
+    pivoted_df['std_deviation'] = pivoted_df.std(axis=1)
+    return filtered_df, pivoted_df
+
+# Function to read the command line options. Anything not given on the command line is prompted for
+def parse_args():
+    parser = argparse.ArgumentParser(description="Travel times on segments between significant intersections from a folder of GPX files.")
+    parser.add_argument('--intersections', help="significant intersections CSV, KML or KMZ file")
+    parser.add_argument('--gpx-folder', help="folder containing the GPX files")
+    parser.add_argument('--output', help="output .xlsx file (i.e. output/AM_before.xlsx)")
+    parser.add_argument('--match', choices=['radius', 'corridor'], default='radius',
+                        help="radius: a signal is hit within 30 m of a trackpoint (default). corridor: snap traces to the "
+                             "KML LineString corridor and interpolate signal crossing times (needs a KML/KMZ with the corridor drawn)")
+    parser.add_argument('--incremental', nargs='?', const='', metavar='STORE',
+                        help="only process GPX files that are new or modified since the last run. Results are kept in the "
+                             "STORE folder (default: next to the output file, i.e. output/AM_before_store)")
+    parser.add_argument('--workers', type=int, default=1, help="number of processes for the GPX files (default 1, 0 = one per CPU core)")
+    return parser.parse_args()
+
 
 def main():
     # Branding and instructions:
-
+    args = parse_args()
     
     # Prompt the user to input file paths
-    intersection_file = input("Enter the file path to the significant intersections CSV or KML file: ") 
+    intersection_file = args.intersections or input("Enter the file path to the significant intersections CSV or KML file: ") 
     # Check if the intersection file exists---------------------------
     if not os.path.exists(intersection_file):
         print("Intersection file path doesn't exist.")
@@ -161,7 +260,7 @@ def main():
         pass
 
 
-    folder_path = input("Enter the folder path to the GPX files: ")
+    folder_path = args.gpx_folder or input("Enter the folder path to the GPX files: ")
     # Check if the folder path exists -----------------------
     if not os.path.exists(folder_path):
         print("GPX folder path doesn't exist.")
@@ -171,7 +270,7 @@ def main():
         pass
 
 
-    output_file = input("Enter the name of the output .xlsx file (i.e. output/AM_before.xlsx): ")
+    output_file = args.output or input("Enter the name of the output .xlsx file (i.e. output/AM_before.xlsx): ")
 
     
 
@@ -181,70 +280,55 @@ def main():
     file_extension = os.path.splitext(intersection_file)[1].lower()
     intersections = None
 
+    kml_file = None
+
     if file_extension == '.csv':
         # Parse CSV file to extract significant intersection information
         intersections = parse_csv(intersection_file)
     elif file_extension == '.kml':
         # parse KML file to extract significant intersection information
-        intersections = parse_kml(intersection_file)
+        kml_file = intersection_file
+        intersections = parse_kml(kml_file)
     elif file_extension == '.kmz':
         # convert KMZ to KML 
-        new_kml_file = convert_kmz_to_kml(intersection_file)
+        kml_file = convert_kmz_to_kml(intersection_file)
         # parse KML to extract significant intersection information
-        intersections = parse_kml(new_kml_file)
+        intersections = parse_kml(kml_file)
     else:
         print("No KML content found in the file.")
 
-    # Iterate over each GPX file
-    all_results = []
-    for filename in os.listdir(folder_path):
-        if filename.endswith('.gpx'):  # Check if the file is a GPX file
-            gpx_file = os.path.join(folder_path, filename)
-            # Parse GPX file and calculate travel times
-            result = parse_gpx_file(gpx_file, intersections)
-            result['route'] = os.path.splitext(filename)[0]  # Extract route name from filename
-            all_results.append(result)
+    # Corridor matching snaps the traces to the LineStrings drawn in the KML
+    matcher = None
+    if args.match == 'corridor':
+        corridors = parse_kml_corridors(kml_file) if kml_file else []
+        if not corridors:
+            print("Corridor matching needs a KML/KMZ file with the corridor drawn as a line (LineString).")
+            sys.exit()
+        matcher = CorridorMatcher(corridors, intersections)
+
+    # Parse every GPX file and calculate travel times
+    if args.incremental is None:
+        all_results, failures = process_gpx_folder(folder_path, intersections, args.workers, matcher)
+    else:
+        store_dir = args.incremental or os.path.splitext(output_file)[0] + '_store'
+        settings = {'intersections': file_digest(intersection_file), 'match': args.match}
+        store = IncrementalStore(store_dir, settings)
+        all_results, failures = process_gpx_folder_incremental(folder_path, intersections, store, args.workers, matcher)
+    if not all_results:
+        print("No GPX files could be processed.")
+        sys.exit()
 
     # Concatenate all results together
     final_result = pd.concat(all_results, ignore_index=True)
 
-    # Format into table
-    # Step 1: Filter out rows where segment_start equals segment_finish
-    filtered_df = final_result[final_result['segment_start'] != final_result['segment_finish']]
-    filtered_df.loc[:,'route'] = filtered_df['segment_start'] + '_to_' + filtered_df['segment_finish']
-    # Add a new column indicating the order of occurrence for each combination
-    filtered_df['run_number'] = filtered_df.groupby('route').cumcount() + 1
-
-    # Convert 'start_time' to datetime and remove timezone information
-    filtered_df['start_time'] = pd.to_datetime(filtered_df['start_time']).dt.tz_localize(None)
-
-    # Get the earliest and latest hours
-    earliest_hour = filtered_df['start_time'].min().floor('H')
-    latest_hour = filtered_df['start_time'].max().ceil('H')
-
-    # Create 15-minute bins
-    time_bins = pd.date_range(start=earliest_hour, end=latest_hour, freq='15T')
-
-    # Create unique labels for the bins (as strings)
-    time_labels = time_bins[:-1].strftime('%Y-%m-%d %H:%M')
-
-    # Assign each row to a time bin
-    filtered_df['time_bin'] = pd.cut(filtered_df['start_time'], bins=time_bins, labels=time_labels, include_lowest=True)
-
-    # Pivot the table based on the new column 'time_bin'
-    pivoted_df = filtered_df.pivot_table(index=['route_ID', 'route'], columns='time_bin', values='travel_time', aggfunc='first')
-
-    # Calculate the average travel time across time bins
-    pivoted_df['average'] = pivoted_df.mean(axis=1)
-
-    # Calculate the standard deviation of travel times across time bins
-    pivoted_df['std_deviation'] = pivoted_df.std(axis=1)
+    filtered_df, pivoted_df = build_tables(final_result)
 
     # Output the total table of all calculated travel times
     print(pivoted_df)
 
     # Write filtered_df to sheet one and pivoted_df to sheet two of an xlsx file    
-    with pd.ExcelWriter(output_file, engine='xlsxwriter') as writer:
+    # (start/end times stay datetimes until here; the writer formats them)
+    with pd.ExcelWriter(output_file, engine='xlsxwriter', datetime_format='yyyy-mm-dd hh:mm:ss') as writer:
         filtered_df.to_excel(writer, sheet_name='Sheet1')
         pivoted_df.to_excel(writer, sheet_name='Sheet2')
     print(f"Output table has been written to {output_file}")
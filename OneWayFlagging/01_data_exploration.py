@@ -1,13 +1,9 @@
-import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
+from flagging_store import read_table
 
-# Load the data
-df = pd.read_csv('total_regression_table.csv')
-
-# Convert 'Start' and 'Stop' columns to datetime
-df['Start'] = pd.to_datetime(df['Start'])
-df['Stop'] = pd.to_datetime(df['Stop'])
+# Load the data (every site's regression table in the flagging store; 'Start' and 'Stop' are seconds since midnight)
+df = read_table('flagging_store', 'regression')
 
 # Create the target variable (capacity)
 df['capacity'] = df['green_time'] / df['avg_headway']
@@ -17,7 +13,7 @@ numeric_features = ['green_time', 'volume', 'Volume_Per_Hour', 'truck_percentage
 categorical_features = ['route_name', 'Direction']
 
 # Select only numeric columns
-numeric_columns = df.select_dtypes(include=['int64', 'float64']).columns
+numeric_columns = df.select_dtypes(include='number').columns
 
 # Create a correlation matrix for numeric columns only
 correlation_matrix = df[numeric_columns].corr()
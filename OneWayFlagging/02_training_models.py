@@ -1,27 +1,11 @@
-from sklearn.model_selection import train_test_split
-from sklearn.linear_model import LinearRegression, Ridge, Lasso, ElasticNet
-from sklearn.preprocessing import StandardScaler
+from flagging_store import read_table
+from flagging_models import capacity_data, train_models
 
-# Prepare the data
-X = df[['green_time', 'volume', 'truck_percentage', 'avg_speed_segment', 'avg_grade_weighted', 'total_distance_segment']]
-y = df['green_time'] / df['avg_headway']  # Capacity
-
-# Split the data
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
+# Load the full regression table from the flagging store
+df = read_table('flagging_store', 'regression')
 
-# Scale the features
-scaler = StandardScaler()
-X_train_scaled = scaler.fit_transform(X_train)
-X_test_scaled = scaler.transform(X_test)
-
-# Train models
-models = {
-    'Linear Regression': LinearRegression(),
-    'Ridge': Ridge(alpha=1.0),
-    'Lasso': Lasso(alpha=1.0),
-    'ElasticNet': ElasticNet(alpha=1.0, l1_ratio=0.5)
-}
+# Prepare the data
+X, y = capacity_data(df)  # Capacity = green_time / avg_headway
 
-for name, model in models.items():
-    model.fit(X_train_scaled, y_train)
-    print(f"{name} trained.")
\ No newline at end of file
+# Train models (5-fold cross-validated grids, in parallel across cores, on a 80/20 train/test split)
+X_test, y_test, results = train_models(X, y, folds=5, workers=-1)
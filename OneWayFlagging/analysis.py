@@ -7,6 +7,7 @@ import os
 from datetime import datetime, time
 import plotly.express as px
 import plotly.graph_objects as go
+from flagging_counts import clean_counts, read_count_file
 
 # Specify the directory containing the Excel files
 directory = 'data'
@@ -18,37 +19,11 @@ def time_to_datetime(t):
 # function that cleans the excel files
 def clean_xlsm(file_path):
     file_path = os.path.join(directory, filename)
-        # Read the Excel file into a dataframe
-    df = pd.read_excel(file_path)
+        # Read the count columns of the Excel file into a dataframe
+    df = read_count_file(file_path)
     
-    # Filter out invalid segments between multiple 'Start's without an intervening 'Stop'
-    segments = []
-    start_idx = None
-    valid_segment = True
-
-    for i, row in df.iterrows():
-        if row['Vehicle'] == 'Start':
-            if start_idx is not None:
-                # Exclude the segment if 'Start' is immediately followed by 'Stop'
-                if i == start_idx + 1 and df.loc[i, 'Vehicle'] == 'Stop':
-                    start_idx = None
-                    valid_segment = False
-                    continue
-            start_idx = i
-            valid_segment = True
-        elif row['Vehicle'] == 'Stop':
-            if start_idx is not None:
-                # Include only segments with valid data between 'Start' and 'Stop'
-                if valid_segment:
-                    segments.append(df.loc[start_idx:i])
-            start_idx = None
-            valid_segment = False
-
-    # Concatenate valid segments into a single DataFrame
-    if segments:
-        cleaned = pd.concat(segments)
-    else:
-        cleaned = pd.DataFrame(columns=file_path.columns)
+    # Keep the valid Start...Stop segments (segments with no vehicles are kept here)
+    cleaned = clean_counts(df, drop_empty=False)
 
     return cleaned 
 
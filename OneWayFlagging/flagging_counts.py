@@ -0,0 +1,131 @@
+# Shared helpers for the one-way flagging count sheets (.xlsm)
+# The count sheets log one row per vehicle ('Car', 'Truck', 'Probe', ...) between 'Start' and 'Stop' rows that
+# mark when the flagger released a platoon. Used by one_way_flagging, regression_table_build and analysis.
+
+import os
+import pickle
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+COUNT_COLUMNS = ['Time Stamp', 'Vehicle', 'Direction']
+
+# Parsed count sheets are cached next to the workbook (<workbook>.counts.pkl) and reused while the workbook's size
+# and modified time are unchanged, so repeated analyses of a project folder skip Excel parsing altogether.
+# Bump READER_VERSION whenever read_count_sheet changes what it produces.
+READER_VERSION = 1
+
+
+# Function to keep only the valid Start...Stop segments of a count sheet
+# A segment runs from the last 'Start' before a 'Stop' to that 'Stop' (inclusive). Rows after a 'Stop' with no
+# 'Start' before the next 'Stop', and anything after the final 'Stop', are dropped. With drop_empty, segments
+# with no vehicles (a 'Start' immediately followed by its 'Stop') are dropped too.
+# Every row is labelled with the block it falls in (cumulative count of the 'Stop's before it) and kept when its
+# block ends in a 'Stop' and the row is at or after the block's last 'Start', so there is no row loop or concat.
+def clean_counts(df, drop_empty=True):
+    vehicle = df['Vehicle'].to_numpy()
+    is_start = vehicle == 'Start'
+    is_stop = vehicle == 'Stop'
+    position = np.arange(len(df))
+
+    # block number of each row: a 'Stop' closes the block it is in
+    stop_position = np.flatnonzero(is_stop)
+    block = np.cumsum(is_stop) - is_stop
+    block_begin = np.concatenate([[0], stop_position + 1])[block]
+    # position of the 'Stop' closing each row's block (-1 for the rows after the final 'Stop')
+    block_stop = np.append(stop_position, -1)[block]
+
+    # position of the latest 'Start' at or before each row, then the block's last 'Start' (the one before its 'Stop')
+    last_start = np.maximum.accumulate(np.where(is_start, position, -1)) if len(df) else position
+    segment_start = last_start[block_stop]
+
+    keep = (block_stop >= 0) & (segment_start >= block_begin) & (position >= segment_start)
+    if drop_empty:
+        # remove consecutive start-stops
+        keep &= block_stop - segment_start > 1
+
+    return df[keep].copy()
+
+
+# Function to convert the count sheets' 'Time Stamp' column (datetime.time values) to a timedelta since midnight
+# Builds integer microseconds straight from the time fields instead of formatting and re-parsing strings
+# (integer seconds since midnight, as the flagging store keeps them, are converted directly)
+def time_of_day(time_stamps):
+    if pd.api.types.is_integer_dtype(time_stamps):
+        return pd.Series(pd.to_timedelta(time_stamps.to_numpy(dtype=np.int64), unit='s'), index=time_stamps.index)
+    microseconds = np.fromiter(((t.hour * 3600 + t.minute * 60 + t.second) * 1000000 + t.microsecond for t in time_stamps),
+                               dtype=np.int64, count=len(time_stamps))
+    return pd.Series(pd.to_timedelta(microseconds, unit='us'), index=time_stamps.index)
+
+# Function to read the count columns (Time Stamp, Vehicle, Direction) of the first sheet of a count workbook
+# Streams the rows through openpyxl in read-only mode and stops at the last count column, instead of loading the
+# whole workbook (every column, the macros' sheets and styles) through pd.read_excel
+def read_count_sheet(xlsm_file, columns=COUNT_COLUMNS):
+    wb = load_workbook(xlsm_file, read_only=True, keep_links=False, data_only=True)
+    try:
+        sheet = wb.worksheets[0]
+        rows = sheet.iter_rows(values_only=True)
+        header = list(next(rows, ()))
+        missing = [column for column in columns if column not in header]
+        if missing:
+            raise ValueError(f"{os.path.basename(xlsm_file)} has no {', '.join(missing)} column (columns: {header})")
+        # the count columns in sheet order, as pd.read_excel would give them
+        positions = sorted(header.index(column) for column in columns)
+        last = positions[-1] + 1
+        data = [row[:last] for row in sheet.iter_rows(min_row=2, max_col=last, values_only=True)]
+    finally:
+        wb.close()
+
+    # drop trailing blank rows (read-only sheets often report formatted but empty rows at the bottom)
+    while data and all(value is None or value == '' for value in data[-1]):
+        data.pop()
+    df = pd.DataFrame(data, columns=header[:last]).iloc[:, positions]
+    df = df.replace('', np.nan).infer_objects()
+    return df
+
+# Function to get a count workbook's cached count sheet (None when it is not cached or the workbook changed)
+def cached_counts(xlsm_file):
+    stat = os.stat(xlsm_file)
+    try:
+        with open(xlsm_file + '.counts.pkl', 'rb') as file:
+            cached = pickle.load(file)
+        if cached['key'] == (READER_VERSION, stat.st_size, stat.st_mtime_ns):
+            return cached['counts']
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError, TypeError, AttributeError):
+        pass  # not cached yet (or unreadable)
+    return None
+
+# Function to read a count workbook through the cache next to it
+def read_count_file(xlsm_file):
+    counts = cached_counts(xlsm_file)
+    if counts is not None:
+        return counts
+
+    stat = os.stat(xlsm_file)
+    counts = read_count_sheet(xlsm_file)
+    cache_file = xlsm_file + '.counts.pkl'
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_file) or '.', suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump({'key': (READER_VERSION, stat.st_size, stat.st_mtime_ns), 'counts': counts}, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_file)
+    except OSError as e:
+        print(f"Could not cache parsed counts to {cache_file}: {e}")
+    return counts
+
+# Function to read several count workbooks, parsing the ones that are not cached in parallel processes
+# Returns the count sheets in the same order as xlsm_files. workers=None uses one process per CPU core.
+def read_count_files(xlsm_files, workers=None):
+    counts = [cached_counts(xlsm_file) for xlsm_file in xlsm_files]
+    pending = [i for i, sheet in enumerate(counts) if sheet is None]
+    if len(pending) <= 1 or workers == 1:
+        parsed = [read_count_file(xlsm_files[i]) for i in pending]
+    else:
+        with ProcessPoolExecutor(max_workers=min(len(pending), workers or os.cpu_count() or 1)) as executor:
+            parsed = list(executor.map(read_count_file, [xlsm_files[i] for i in pending]))
+    for i, sheet in zip(pending, parsed):
+        counts[i] = sheet
+    return counts
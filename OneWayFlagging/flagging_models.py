@@ -0,0 +1,82 @@
+# Capacity models for the one-way flagging regression table
+# Fits LinearRegression, Ridge, Lasso and ElasticNet with k-fold cross-validation over a hyperparameter grid,
+# run in parallel across cores. Each model is a StandardScaler + regressor pipeline whose fitted scaler and scaled
+# feature matrix are cached on disk (per training fold), so the grid points of a fold share one scaling instead of
+# re-scaling for every fit. The test split is predicted once per model and the predictions are kept with the results.
+
+import os
+
+import numpy as np
+import pandas as pd
+from sklearn.linear_model import ElasticNet, Lasso, LinearRegression, Ridge
+from sklearn.metrics import mean_squared_error, r2_score
+from sklearn.model_selection import GridSearchCV, KFold, train_test_split
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+FEATURES = ['green_time', 'volume', 'truck_percentage', 'avg_speed_segment', 'avg_grade_weighted', 'total_distance_segment']
+
+# Scaled feature matrices are cached here (by the pipelines' joblib memory); set MODEL_CACHE_DIR to move the cache
+# (or to an empty string to turn it off)
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'avenue-tools', 'flagging-models'))
+
+# Regressor and hyperparameter grid of each model (grid keys address the pipeline's 'model' step)
+MODEL_GRIDS = {
+    'Linear Regression': (LinearRegression(), {}),
+    'Ridge': (Ridge(), {'model__alpha': np.logspace(-3, 3, 13)}),
+    'Lasso': (Lasso(max_iter=10000), {'model__alpha': np.logspace(-3, 1, 9)}),
+    'ElasticNet': (ElasticNet(max_iter=10000), {'model__alpha': np.logspace(-3, 1, 9), 'model__l1_ratio': [0.1, 0.5, 0.9]}),
+}
+
+
+# Function to get the feature matrix and the capacity target (green time / average headway) from a regression table
+# Rows missing a feature or the target are dropped
+def capacity_data(df, features=FEATURES):
+    X = df[features].astype(np.float64)
+    y = (df['green_time'] / df['avg_headway']).astype(np.float64)  # Capacity
+    valid = X.notna().all(axis=1) & np.isfinite(y)
+    return X[valid].reset_index(drop=True), y[valid].reset_index(drop=True)
+
+
+# Function to fit every model's grid with k-fold cross-validation and score it on a held-out test split
+# workers is the number of processes for the folds and grid points (-1 = one per CPU core).
+# Returns the test split and one result per model: the refitted best pipeline, its parameters, the mean
+# cross-validated R-squared, and the test predictions with their MSE and R-squared.
+def train_models(X, y, folds=5, workers=-1, test_size=0.2, random_state=42, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = MODEL_CACHE_DIR
+
+    # Split the data
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=random_state)
+    cv = KFold(n_splits=folds, shuffle=True, random_state=random_state)
+
+    results = {}
+    for name, (model, grid) in MODEL_GRIDS.items():
+        pipeline = Pipeline([('scaler', StandardScaler()), ('model', model)], memory=cache_dir or None)
+        search = GridSearchCV(pipeline, grid, cv=cv, scoring='r2', n_jobs=workers, refit=True)
+        search.fit(X_train, y_train)
+
+        # Predict the test split once per model
+        y_pred = search.predict(X_test)
+        results[name] = {
+            'model': search.best_estimator_,
+            'params': search.best_params_,
+            'cv_r2': search.best_score_,
+            'predictions': y_pred,
+            'mse': mean_squared_error(y_test, y_pred),
+            'r2': r2_score(y_test, y_pred),
+        }
+        print(f"{name} trained (cross-validated R-squared {search.best_score_:.3f}).")
+
+    return X_test, y_test, results
+
+
+# Function to pick the best model by test R-squared from the stored scores (nothing is predicted again)
+def best_model(results):
+    return max(results.items(), key=lambda item: item[1]['r2'])
+
+
+# Function to summarize the results as a table (one row per model)
+def results_table(results):
+    return pd.DataFrame([{'model': name, 'params': result['params'], 'cv_r2': result['cv_r2'],
+                          'mse': result['mse'], 'r2': result['r2']} for name, result in results.items()])
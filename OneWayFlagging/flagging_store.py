@@ -0,0 +1,167 @@
+# Typed analysis store for the one-way flagging tables (count, headway, cycle and regression tables)
+# Every table is kept as Parquet files under <store>/<table>/<name>.parquet (one file per site/study, so a site
+# can be re-run without touching the others) and a whole season is loaded by reading every file of a table.
+# Excel stays an export of the analysis; the models and later analyses read the store.
+#
+# Schema (column -> stored type):
+#   seconds  - integer seconds since midnight (int32, Int32 when the column has missing values). The count sheets
+#              only hold times of day, so 'Time Stamp', 'Start Time', 'Start' and 'Stop' lose nothing
+#   category - dictionary-encoded strings (Direction, Vehicle, Group, route_name, ...)
+#   int32    - whole numbers with no missing values (ids)
+#   float32  - measurements (seconds, counts after a left merge, speeds, grades, percentages, rates)
+# Only the schema columns are written, in schema order; columns missing from a frame are skipped.
+
+import os
+import tempfile
+from datetime import time
+
+import numpy as np
+import pandas as pd
+
+from flagging_counts import time_of_day
+
+STORE_SCHEMAS = {
+    # cleaned count sheets (readin_counts)
+    'counts': {
+        'Time Stamp': 'seconds',
+        'Direction': 'category',
+        'Vehicle': 'category',
+    },
+    # count sheets with headways (calculate_headway)
+    'headway': {
+        'Time Stamp': 'seconds',
+        'Direction': 'category',
+        'Vehicle': 'category',
+        'Headway': 'float32',
+        'Following': 'category',
+        'Group': 'category',
+    },
+    # cycle summary (process_cycles)
+    'cycles': {
+        'Start Time': 'seconds',
+        'Cycle ID': 'int32',
+        'Direction': 'category',
+        'Cycle Length': 'float32',
+        'Split Length': 'float32',
+        'Green Time': 'float32',
+        'Red Time': 'float32',
+        'All Red Time': 'float32',
+        'Volume': 'float32',
+        'Average Headway': 'float32',
+    },
+    # regression table (regression_table_build.process_folder)
+    'regression': {
+        'route_name': 'category',
+        'Direction': 'category',
+        'split_id': 'int32',
+        'Start': 'seconds',
+        'Stop': 'seconds',
+        'green_time': 'float32',
+        'previous_red_time': 'float32',
+        'previous_split_time': 'float32',
+        'previous_red_clearance': 'float32',
+        'after_green_all_red': 'float32',
+        'cycle_length': 'float32',
+        'cycles_per_hour': 'float32',
+        'green_time_per_hour': 'float32',
+        'red_time_per_hour': 'float32',
+        'after_green_all_red_per_hour': 'float32',
+        'avg_speed_queue': 'float32',
+        'avg_speed_segment': 'float32',
+        'avg_grade_weighted': 'float32',
+        'total_distance_segment': 'float32',
+        'volume': 'float32',
+        'truck_percentage': 'float32',
+        'avg_headway': 'float32',
+        'Volume_Per_Hour': 'float32',
+        'hourly_flow_rate_green': 'float32',
+        'hourly_flow_rate_red': 'float32',
+    },
+}
+
+
+# Function to convert a column of times of day to integer seconds since midnight
+# Accepts datetime.time values (count sheets), datetimes (the regression table's Start/Stop, whose date is just
+# the day the table was built), datetime strings (a CSV export) or seconds that are already integers
+def to_seconds(values):
+    values = pd.Series(values)
+    if pd.api.types.is_integer_dtype(values):
+        seconds = values
+    elif pd.api.types.is_timedelta64_dtype(values):
+        seconds = values.dt.total_seconds()
+    elif pd.api.types.is_datetime64_any_dtype(values):
+        seconds = (values - values.dt.normalize()).dt.total_seconds()
+    else:
+        present = values.dropna()
+        if len(present) and all(isinstance(value, time) for value in present):
+            seconds = pd.Series(np.nan, index=values.index)
+            seconds.loc[present.index] = time_of_day(present).dt.total_seconds()
+        else:
+            return to_seconds(pd.to_datetime(values))
+    seconds = seconds.round()
+    return seconds.astype('Int32' if seconds.isna().any() else 'int32')
+
+
+# Function to convert integer seconds since midnight back to datetime.time values (for the Excel export)
+def to_time_of_day(seconds):
+    seconds = pd.Series(seconds)
+    return seconds.map(lambda s: None if pd.isna(s) else time(int(s) // 3600, int(s) // 60 % 60, int(s) % 60))
+
+
+# Function to cast a table to its store schema (schema columns only, in schema order)
+def to_store(df, table):
+    schema = STORE_SCHEMAS[table]
+    typed = {}
+    for column, kind in schema.items():
+        if column not in df.columns:
+            continue
+        values = df[column].reset_index(drop=True)
+        if kind == 'seconds':
+            typed[column] = to_seconds(values)
+        elif kind == 'category':
+            typed[column] = values.astype(str).where(values.notna()).astype('category')
+        else:
+            typed[column] = values.astype(kind)
+    return pd.DataFrame(typed, index=pd.RangeIndex(len(df)))
+
+
+# Function to write a table to the store as <store>/<table>/<name>.parquet (replacing that name's previous file)
+# The file is written next to its final path and renamed into place, so a reader never sees half a file
+def write_table(df, store, table, name):
+    folder = os.path.join(store, table)
+    os.makedirs(folder, exist_ok=True)
+    path = os.path.join(folder, f"{name}.parquet")
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    os.close(fd)
+    try:
+        to_store(df, table).to_parquet(tmp_path, engine='pyarrow', index=False, compression='zstd')
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return path
+
+
+# Function to list the names stored for a table
+def table_names(store, table):
+    folder = os.path.join(store, table)
+    if not os.path.isdir(folder):
+        return []
+    return sorted(os.path.splitext(filename)[0] for filename in os.listdir(folder) if filename.endswith('.parquet'))
+
+
+# Function to read a table from the store: every name (a whole season) or only the given names, and only the given
+# columns. The categorical columns are re-encoded over all the files read, so they stay categorical.
+def read_table(store, table, names=None, columns=None):
+    if names is None:
+        names = table_names(store, table)
+    if not names:
+        raise FileNotFoundError(f"No '{table}' table in the flagging store {store}")
+
+    frames = [pd.read_parquet(os.path.join(store, table, f"{name}.parquet"), engine='pyarrow', columns=columns)
+              for name in names]
+    df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    for column, kind in STORE_SCHEMAS[table].items():
+        if kind == 'category' and column in df.columns and not isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype('category')
+    return df
@@ -16,20 +16,26 @@
 # --------------------------------------------------------------------------------------------------------------------------------------------
 import pandas as pd
 import os
+import sys
 from datetime import datetime, time
 import plotly.express as px
 import plotly.graph_objects as go
 import plotly.io as pio
 import numpy as np
-import xml.etree.ElementTree as ET
 import pytz
 import folium
 import geopandas as gpd
 from fastkml import kml
-import gpxpy
 import zipfile
 import matplotlib.pyplot as plt
 
+# Shared columnar GPX tracks live with the GPXReader tools
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'GPXReader'))
+from gpx_tracks import Track, IntersectionIndex, hit_pairs, MPS_TO_MPH
+from gpx_maps import base_map, add_speed_points
+from flagging_counts import clean_counts, read_count_files, time_of_day
+from flagging_store import write_table
+
 # Define Salt Lake City's timezone
 LOCAL_TZ = pytz.timezone('America/Denver')
 
@@ -56,62 +62,16 @@ def print_ascii_art():
     for line in Fire:
         print(line)
 
-# function that cleans the excel files
-def clean_xlsm(filename):
-    file_path = os.path.join(directory, filename)
-    # Read the Excel file into a dataframe
-    df = pd.read_excel(file_path)
-    
-    # Filter out invalid segments between multiple 'Start's without an intervening 'Stop'
-    segments = []
-    start_idx = None
-    valid_segment = True
-
-    for i, row in df.iterrows():
-        if row['Vehicle'] == 'Start':
-            if start_idx is not None:
-                # Exclude the segment if 'Start' is immediately followed by 'Stop'
-                if i == start_idx + 1 and df.loc[i, 'Vehicle'] == 'Stop':
-                    start_idx = None
-                    valid_segment = False
-                    continue
-            start_idx = i
-            valid_segment = True
-        elif row['Vehicle'] == 'Stop':
-            if start_idx is not None:
-                # Include only segments with valid data between 'Start' and 'Stop'
-                if valid_segment:
-                    segments.append(df.loc[start_idx:i])
-            start_idx = None
-            valid_segment = False
-
-    # Concatenate valid segments into a single DataFrame
-    if segments:
-        cleaned = pd.concat(segments)
-    else:
-        cleaned = pd.DataFrame(columns=filename.columns)
-
-    # remove consecutive start-stops
-    drop_rows = cleaned[(cleaned['Vehicle'] == 'Start') & (cleaned['Vehicle'].shift(-1) == 'Stop')].index
-    drop_rows = drop_rows.union(drop_rows+1)
-
-    cleaned = cleaned.drop(drop_rows)
-
-    return cleaned
-
 # function that reads in excel, cleans, combines, and filters the data
 def readin_counts(file_path):
-    # List to hold dataframes
-    df_list = []
+    # Read every .xlsm in the directory (in parallel, through the parsed-counts cache)
+    filenames = [filename for filename in os.listdir(file_path) if filename.endswith(".xlsm")]
+    for filename in filenames:
+        print(f'Processing file: {filename}')
+    count_sheets = read_count_files([os.path.join(file_path, filename) for filename in filenames])
 
-    # Iterate over all files in the directory
-    for filename in os.listdir(file_path):
-        if filename.endswith(".xlsm"):
-            # run clean function
-            print(f'Processing file: {filename}')
-            clean_df = clean_xlsm(filename)
-            # Append the dataframe to the list
-            df_list.append(clean_df)
+    # run clean function on each sheet
+    df_list = [clean_counts(count_sheet) for count_sheet in count_sheets]
 
     # Concatenate all dataframes in the list into a single dataframe
     combined_df = pd.concat(df_list, ignore_index=True)
@@ -127,57 +87,80 @@ def readin_counts(file_path):
 
     return filtered_df
 
-# write fucntion to convert Time Stamp to a datetime variable
-def time_to_datetime(t):
-    return datetime.combine(datetime.today(), t)
-
-# Define a function to determine the 'Group' value based on conditions
-def determine_group(row):
-    if row['Vehicle'] == 'Truck' and row['Following'] == 'Truck':
-        return 'Truck Following Truck'
-    elif row['Vehicle'] == 'Car' and row['Following'] == 'Truck':
-        return 'Car Following Truck'
-    elif row['Vehicle'] == 'Truck' and row['Following'] == 'Car':
-        return 'Truck Following Car'
-    elif row['Vehicle'] == 'Car' and row['Following'] == 'Car':
-        return 'Car Following Car'
-    elif row['Vehicle'] == 'Car' and row['Following'] == 'Start':
-        return 'Car Following Start'
-    elif row['Vehicle'] == 'Truck' and row['Following'] == 'Start':
-        return 'Truck Following Start'
-    else:
-        return None
+# 'Group' value for each (Vehicle, Following) combination; any other combination has no group
+HEADWAY_GROUPS = {
+    ('Truck', 'Truck'): 'Truck Following Truck',
+    ('Car', 'Truck'): 'Car Following Truck',
+    ('Truck', 'Car'): 'Truck Following Car',
+    ('Car', 'Car'): 'Car Following Car',
+    ('Car', 'Start'): 'Car Following Start',
+    ('Truck', 'Start'): 'Truck Following Start',
+}
+
+# Function to determine the 'Group' value of every row at once from the lookup table
+def determine_groups(vehicle, following):
+    vehicle = np.asarray(vehicle, dtype=object)
+    following = np.asarray(following, dtype=object)
+    groups = np.full(len(vehicle), None, dtype=object)
+    for (vehicle_type, following_type), group in HEADWAY_GROUPS.items():
+        groups[(vehicle == vehicle_type) & (following == following_type)] = group
+    return groups
 
 # function converts count_data to headway_data. 
 def calculate_headway(data):
     df = data.copy()
-    # Convert 'time stamp' to datetime for continuous axis plotting
-    df['Timestamp'] = df['Time Stamp'].apply(time_to_datetime)
+    # Time of day as a timedelta since midnight, for the whole column at once
+    since_midnight = time_of_day(df['Time Stamp'])
 
     # Calculate the 'Headway' column and convert to seconds
-    df['Headway'] = df['Timestamp'].diff().dt.total_seconds()
-    # Create the 'Following' column by shifting the 'classification' column
-    df['Following'] = df['Vehicle'].shift(1).apply(lambda x: 'Car' if x == 'Probe' else x)
-    # Create the 'Group' column using the determine_group function
-    df['Group'] = df.apply(determine_group, axis=1)
+    df['Headway'] = since_midnight.diff().dt.total_seconds()
+    # Create the 'Following' column by shifting the 'classification' column (probes count as cars)
+    df['Following'] = df['Vehicle'].shift(1).replace('Probe', 'Car')
+    # Create the 'Group' column from the (Vehicle, Following) lookup table
+    df['Group'] = determine_groups(df['Vehicle'], df['Following'])
 
     # Assign Nan to 'Headway' for rows where classification is 'stop' or 'start'
-    df.loc[df['Vehicle'] == 'Stop', 'Headway'] = float('nan')
-    df.loc[df['Vehicle'] == 'Start', 'Headway'] = float('nan')
-
-    # Remove column 'Timestamp' in-place
-    df.drop('Timestamp', axis=1, inplace=True)
-
+    df.loc[df['Vehicle'].isin(['Stop', 'Start']), 'Headway'] = float('nan')
 
     return df
 
+# Function to decimate the headway bars to at most max_bars: the time axis of each direction is cut into equal
+# bins and the longest headway of each bin is kept, so the gaps that show collection problems stay visible
+def decimate_headway(bars, seconds, max_bars):
+    if len(bars) <= max_bars:
+        return bars
+    directions = max(bars['Direction'].nunique(), 1)
+    bins = max(max_bars // directions, 1)
+    span = max(seconds.max() - seconds.min(), 1)
+    time_bin = np.minimum(((seconds - seconds.min()) / span * bins).astype(np.int64), bins - 1)
+    keep = bars['Headway'].groupby([bars['Direction'], time_bin]).idxmax()
+    return bars[bars.index.isin(keep.to_numpy())]
+
+# Function to draw every Start (green) or Stop (red) as one line trace: the vertical lines are joined into a single
+# scatter trace, separated by gaps, instead of one layout shape per row
+def cycle_marker_trace(timestamps, name, color, height):
+    x = np.repeat(timestamps.to_numpy(dtype='datetime64[us]'), 3).astype(object)
+    x[2::3] = None
+    y = np.tile(np.array([0, height, None], dtype=object), len(timestamps))
+    return go.Scatter(x=x, y=y, mode='lines', name=name, line=dict(color=color, width=2), hoverinfo='skip')
+
 # visualize headway
-def visualize_headway(df):
+# fast draws all the Start/Stop lines as two traces and decimates the bars to max_bars, so the chart builds in about
+# the same time whatever the number of runs; fast=False adds one vline per Start/Stop row (slow for long counts)
+def visualize_headway(df, fast=True, max_bars=20000):
     data = df.copy()
     # Convert 'time stamp' to datetime for continuous axis plotting
-    data['Timestamp'] = data['Time Stamp'].apply(time_to_datetime)
+    since_midnight = time_of_day(data['Time Stamp'])
+    data['Timestamp'] = pd.Timestamp(datetime.today().date()) + since_midnight
+
+    bars = data
+    if fast:
+        # only vehicles have a headway; thin out the bars when there are too many
+        has_headway = data['Headway'].notna()
+        bars = decimate_headway(data[has_headway], since_midnight[has_headway].dt.total_seconds(), max_bars)
+
     # Create a bar chart using Plotly
-    fig = px.bar(data, x='Timestamp', y='Headway', 
+    fig = px.bar(bars, x='Timestamp', y='Headway', 
                 title='Headway Over Time - Visualize the Data Collection',
                 # labels={'Time Stamp': 'Time Stamp', 'Headway': 'Headway (seconds)'},
                 hover_data={'Time Stamp': True, 'Headway': True, 'Group': True, 'Timestamp': False},
@@ -185,11 +168,16 @@ def visualize_headway(df):
                 color_discrete_map={'EB': 'Black', 'WB': 'DarkRed', 'NB': 'DarkBlue', 'SB': 'DarkGreen'})  # Example color mapping
 
     # Add vertical lines for 'start' and 'stop'
-    for _, row in data.iterrows():
-        if row['Vehicle'] == 'Start':
-            fig.add_vline(x=row['Timestamp'], line=dict(color='green', width=2))
-        elif row['Vehicle'] == 'Stop':
-            fig.add_vline(x=row['Timestamp'], line=dict(color='red', width=2))
+    if fast:
+        height = bars['Headway'].max() if len(bars) else 1
+        for vehicle, color in [('Start', 'green'), ('Stop', 'red')]:
+            fig.add_trace(cycle_marker_trace(data.loc[data['Vehicle'] == vehicle, 'Timestamp'], vehicle, color, height))
+    else:
+        for _, row in data.iterrows():
+            if row['Vehicle'] == 'Start':
+                fig.add_vline(x=row['Timestamp'], line=dict(color='green', width=2))
+            elif row['Vehicle'] == 'Stop':
+                fig.add_vline(x=row['Timestamp'], line=dict(color='red', width=2))
 
     # Adjust the bar thickness by setting bargap
     fig.update_layout(bargap=0.1)  # Adjust this value to control the gap between bars
@@ -215,70 +203,23 @@ def format_headway(data):
 
     return excel
 
-# Haversine formula to calculate distance between two points on Earth
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371000  # Earth radius in meters
-    
-    dlat = np.radians(lat2 - lat1)
-    dlon = np.radians(lon2 - lon1)
-    
-    a = np.sin(dlat / 2) ** 2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(dlon / 2) ** 2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
-    
-    distance = R * c  # in meters
-    return distance
-
 # Function to parse GPX file and calculate speed (and grade) returns a df
 def parse_gpx(file_path):
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-
-    namespaces = {
-        'gpx': 'http://www.topografix.com/GPX/1/1'
-    }
-    
-    data = []
-    previous_point = None
-    previous_time = None
-    previous_elevation = None
-    
-    for trkpt in root.findall('.//gpx:trkpt', namespaces):
-        timestamp = trkpt.find('gpx:time', namespaces).text
-        lat = float(trkpt.get('lat'))
-        lon = float(trkpt.get('lon'))
-        elevation_str = trkpt.find('gpx:ele', namespaces).text
-        elevation = float(elevation_str) # in meters
-
-        
-        # Handle different timestamp formats
-        try:
-            time_of_day_utc = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ')
-        except ValueError:
-            time_of_day_utc = datetime.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ')
-        
-        # Convert UTC time to local time
-        time_of_day_local = time_of_day_utc.replace(tzinfo=pytz.utc).astimezone(LOCAL_TZ)
-        
-        if previous_point is not None and previous_time is not None:
-            distance = haversine(previous_point[0], previous_point[1], lat, lon) # meters
-            time_diff = (time_of_day_local - previous_time).total_seconds()  # time difference in seconds
-            elevation_diff = elevation - previous_elevation
-            speed = distance / time_diff if time_diff != 0 else 0
-            speed_mph = speed * 2.23694  # convert speed to mph
-            grade = elevation_diff / distance * 100 if distance != 0 else 0
-        else:
-            speed = 0.0
-            speed_mph = 0.0
-            distance = 0.0
-            grade = 0.0
-
-        
-        data.append([time_of_day_local.strftime('%H:%M:%S'), lat, lon, distance, speed, speed_mph, elevation, grade])
-        previous_point = (lat, lon)
-        previous_time = time_of_day_local
-        previous_elevation = elevation
-    
-    df = pd.DataFrame(data, columns=['TimeOfDay', 'Latitude', 'Longitude', 'Distance (m)', 'Speed', 'Speed (mph)', 'Elevation', 'Grade (%)'])
+    track = Track.from_gpx(file_path)
+
+    # Convert UTC time to local time for the whole track at once
+    local_time = track.local_times(LOCAL_TZ)
+    speed = track.speeds()  # m/s
+
+    df = pd.DataFrame({
+        'TimeOfDay': local_time.strftime('%H:%M:%S'),
+        'Latitude': track.lat,
+        'Longitude': track.lon,
+        'Distance (m)': track.distances(),
+        'Speed': speed,
+        'Speed (mph)': speed * MPS_TO_MPH,
+        'Elevation': track.elevation,  # meters
+        'Grade (%)': track.grades()})
 
     bins = [-float('inf'), 3, 15, 30, float('inf')]
     labels = ['Below 3 mph', '3-15 mph', '15-30 mph', 'Above 30 mph']
@@ -307,30 +248,13 @@ def readin_gpx(file_path):
     return df
 
 # Function to plot data on a map
-def plot_data_on_map(df, output_path, json_points):
+# mode is one of gpx_maps.MAP_MODES ('lines', 'geojson' or 'markers'); decimate_m thins the points to one per grid cell
+def plot_data_on_map(df, output_path, json_points, mode='lines', decimate_m=None):
     # Create a base map
-    m = folium.Map(tiles="cartodb positron", location=[df['Latitude'].mean(), df['Longitude'].mean()], zoom_start=12)
-    
-    # Define color for each speed category
-    colors = {
-        'Below 3 mph': 'red',
-        '3-15 mph': 'orange',
-        '15-30 mph': 'yellow',
-        'Above 30 mph': 'green'
-    }
+    m = base_map(df, mode)
 
-    # Add points to the map
-    for _, row in df.iterrows():
-        folium.CircleMarker(
-            location=[row['Latitude'], row['Longitude']],
-            radius=5,
-            color=colors[row['SpeedCategory']],
-            # fill=True,
-            fill_color= colors[row['SpeedCategory']], #'RdYlGn',
-            fill_opacity=0.7,
-            legend_name = 'Speed from GPX Data',
-            popup=f"Time: {row['TimeOfDay']}<br>Speed: {row['Speed']} mph<br>Lat: {row['Latitude']}<br>Lon: {row['Longitude']}"
-        ).add_to(m)
+    # Add points to the map, batched by speed category
+    add_speed_points(m, df, mode, decimate_m)
 
     # Add JSON points to the map
     for point in json_points:
@@ -393,16 +317,8 @@ def parse_kml(folder):
                             
     return intersections
 
-# Function to calculate travel time between two timestamps (in seconds). This function is used in the process travel times function
-def calculate_travel_time(start_time, end_time):
-    start_datetime = datetime.strptime(start_time, '%Y-%m-%dT%H:%M:%SZ')
-    end_datetime = datetime.strptime(end_time, '%Y-%m-%dT%H:%M:%SZ')
-    return (end_datetime - start_datetime).total_seconds()
-
 # Function to parse GPX file and calculate travel times
 def process_travel_times(folder, intersections, speed_limit_mph):
-    gpx_data = []
-
     # search folder for the kml file
     for filename in os.listdir(folder):
         if filename.lower().endswith('.gpx'):
@@ -411,70 +327,39 @@ def process_travel_times(folder, intersections, speed_limit_mph):
             # ---- # add something to join multiple gpx files just in case
             gpx_file = file_path
 
-    # Parse the GPX file
-    with open(gpx_file, 'r') as gpx_file:
-        gpx = gpxpy.parse(gpx_file)
-        # Extract data from GPX
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    gpx_data.append({'lat': point.latitude, 'lon': point.longitude, 'time': point.time.strftime('%Y-%m-%dT%H:%M:%SZ')})
-
-    # Initialize variables
-    output_data = []  # Initialize output data list
-    prev_intersection = None  # Initialize previous intersection
-    cumulative_distance = 0.0  # Initialize cumulative distance
-
-    # Iterate through each point in GPX data
-    for i, point in enumerate(gpx_data):
-        closest_intersection = None
-        # Iterate through each significant intersection
-        for intersection in intersections:
-            # Calculate the distance between the current point and the intersection
-            distance = haversine(point['lat'], point['lon'], intersection['lat'], intersection['lon'])
-            # Check if the distance is within the threshold (50 feet)
-            if distance <= 15:  # 50 feet in meters
-                closest_intersection = intersection
-                # Assign the time of the current point to the closest intersection
-                closest_intersection['time'] = point['time']
-                break  # Exit the loop if a significant intersection is found within the threshold
-
-        # Add distance between consecutive GPX points to cumulative distance
-        if i > 0:
-            cumulative_distance += haversine(gpx_data[i-1]['lat'], gpx_data[i-1]['lon'], point['lat'], point['lon'])
-
-
-        # If a closest intersection is found within the threshold, process it
-        if closest_intersection:
-            if prev_intersection:
-                # Calculate travel time between the previous intersection and the current closest intersection
-                travel_time = calculate_travel_time(prev_intersection['time'], point['time'])
-                # Convert cumulative distance from meters to miles
-                total_distance_miles = cumulative_distance * 0.000621371
-                # Calculate average speed in mph
-                average_speed = (total_distance_miles / (travel_time / 3600)) if travel_time > 0 else 0
-                # Calculate expected travel time based on speed limit
-                expected_travel_time = total_distance_miles / speed_limit_mph * 3600  # in seconds
-                # Calculate delay
-                delay = travel_time - expected_travel_time
-                
-                # Store the segment start, segment finish, travel time, total distance, and average speed in the output data
-                output_data.append({
-                    'route_ID': prev_intersection['route_id'] + ' / ' + closest_intersection['route_id'],
-                    'segment_start': prev_intersection['segment_id'],
-                    'segment_finish': closest_intersection['segment_id'],
-                    'total_distance (mi)': cumulative_distance * 0.000621371,
-                    'speed_limit (mph)': speed_limit_mph,
-                    'average_speed (mph)': average_speed,
-                    'travel_time (sec)': travel_time,
-                    'expected_travel_time': expected_travel_time,
-                    'delay': delay
-                })
-            prev_intersection = closest_intersection
-            cumulative_distance = 0.0  # Reset cumulative distance
-
-    # Convert output data to DataFrame
-    output_df = pd.DataFrame(output_data)
+    # Parse the GPX file into columnar arrays
+    track = Track.from_gpx(gpx_file)
+
+    # Find the first significant intersection within 15 m (50 feet) of every point, then pair consecutive hits
+    matches = IntersectionIndex(intersections, 15).match(track.lat, track.lon)
+    prev_point, start_point, point, prev_intersection, intersection = hit_pairs(matches)
+
+    # Travel time in whole seconds from integer epoch times (time stamps have always been read to the second)
+    seconds = track.epoch_seconds()
+    travel_time = (seconds[point] - seconds[start_point]).astype(np.float64)
+    # Distance travelled between consecutive hits, converted from meters to miles
+    cumulative_distance = track.cumulative_distances()
+    total_distance_miles = (cumulative_distance[point] - cumulative_distance[prev_point]) * 0.000621371
+    # Calculate average speed in mph
+    average_speed = np.divide(total_distance_miles, travel_time / 3600, out=np.zeros(len(point)), where=travel_time > 0)
+    # Calculate expected travel time based on speed limit
+    expected_travel_time = total_distance_miles / speed_limit_mph * 3600  # in seconds
+
+    route_ids = np.array([i['route_id'] for i in intersections], dtype=object)
+    segment_ids = np.array([i['segment_id'] for i in intersections], dtype=object)
+
+    # Store the segment start, segment finish, travel time, total distance, and average speed in the output data
+    output_df = pd.DataFrame({
+        'route_ID': route_ids[prev_intersection] + ' / ' + route_ids[intersection],
+        'segment_start': segment_ids[prev_intersection],
+        'segment_finish': segment_ids[intersection],
+        'total_distance (mi)': total_distance_miles,
+        'speed_limit (mph)': speed_limit_mph,
+        'average_speed (mph)': average_speed,
+        'travel_time (sec)': travel_time,
+        'expected_travel_time': expected_travel_time,
+        'delay': travel_time - expected_travel_time
+    })
     return output_df
 
 def summarize_counts(df):
@@ -500,115 +385,69 @@ def summarize_counts(df):
 
 def process_cycles(data):
     # Convert 'time stamp' to datetime for continuous axis plotting
-    data['Timestamp'] = data['Time Stamp'].apply(time_to_datetime)
+    since_midnight = time_of_day(data['Time Stamp'])
+    data['Timestamp'] = pd.Timestamp(datetime.today().date()) + since_midnight
+
+    # Number the runs (Start to Stop) of each direction and measure each vehicle's headway within its run
+    # (the first vehicle from the Start), so volume and headway can be summarized per cycle with groupby
+    is_start = data['Vehicle'] == 'Start'
+    is_vehicle = ~data['Vehicle'].isin(['Start', 'Stop'])
+    run = is_start.groupby(data['Direction']).cumsum()
+    run_headway = since_midnight.groupby([data['Direction'], run]).diff().dt.total_seconds()
+    run_summary = pd.DataFrame({'Direction': data['Direction'], 'Run': run, 'Headway': run_headway})[is_vehicle]
+    run_summary = run_summary.groupby(['Direction', 'Run']).agg(Volume=('Headway', 'size'), **{'Average Headway': ('Headway', 'mean')})
+
     # filter data to only start and stop
-    df = data[data['Vehicle'].isin(['Start', 'Stop'])].reset_index(drop=True)
-
-
-    # Initialize result dictionary
-    cycle_summary  = {
-        'Start Time': [],
-        'Cycle ID': [],
-        'Direction': [],
-        'Cycle Length': [],
-        'Split Length': [],
-        'Green Time': [],
-        'Red Time': [],
-        'All Red Time': []
-    }
+    cycle_rows = data['Vehicle'].isin(['Start', 'Stop'])
+    df = data[cycle_rows].reset_index(drop=True)
+    start_run = run[cycle_rows].to_numpy()
 
     # Determine the primary direction
     primary_direction = df.iloc[0]['Direction']
     opposite_direction = df[df['Direction'] != primary_direction]['Direction'].iloc[0]
 
-    cycle_id = 0
-
-    # loop through the rows in the cycle data frame created above where i is each row.
-    # the perfect cycle is start stop start stop in both directions.
-    # in the case that one direction is skipped, this formula uses NA and moves on to the next cycle starting in the primary direction
+    # The perfect cycle is start stop start stop in both directions, so every second row (i) starts a split.
+    # A cycle starts at each split in the primary direction; it is complete when the (i+2)th split is the opposite
+    # direction and the (i+4)th is the primary direction again, otherwise both directions of the cycle are NA.
+    # Splits too close to the end of the data for a full cycle are left out.
     # and I trust that the data cleaning up to this point guarantees at least a start stop pattern
-    for i in range(0, len(df), 2):
-        if (df.loc[i, 'Direction'] == primary_direction):
-
-            # Cycle ID for unique identification
-            cycle_id = cycle_id + 1
-
-            # Start time of the cycle
-            start_time = df.loc[i, 'Time Stamp']
-
-            # Ensure i+2 and i+4 are within the valid range before accessing them
-            if i+2 < len(df) and i+4 < len(df):
-        
-                # Check that ith row is the primary direction and the (i+4)th row direction matches the ith row direction and that the (i+2)th direction is opposite direction
-                if (df.loc[i+2, 'Direction'] == opposite_direction and 
-                    df.loc[i+4, 'Direction'] == df.loc[i, 'Direction']):
-
-                    # Calculate cycle length
-                    cycle_length = (df.loc[(i + 4), 'Timestamp'] - df.loc[i, 'Timestamp']).total_seconds()
-                        
-                    
-                    # Calculate split lengths
-                    split_length_primary_to_opposite = (df.loc[i+2, 'Timestamp'] - df.loc[i, 'Timestamp']).total_seconds()
-                    split_length_opposite_to_primary = (df.loc[i+4, 'Timestamp'] - df.loc[i+2, 'Timestamp']).total_seconds()
-                    
-
-                    # Calculate green times
-                    green_time_primary = (df.loc[i+1, 'Timestamp'] - df.loc[i, 'Timestamp']).total_seconds()
-                    green_time_opposite = (df.loc[i+3, 'Timestamp'] - df.loc[i+2, 'Timestamp']).total_seconds()
-
-                    # Calculate red times
-                    red_time_primary = cycle_length - green_time_primary
-                    red_time_opposite = cycle_length - green_time_opposite
-                    
-
-                    # Calculate all red times
-                    all_red_time_primary_to_opposite = split_length_primary_to_opposite - green_time_primary
-                    all_red_time_opposite_to_primary = split_length_opposite_to_primary - green_time_opposite
-                    
-                    
-                    # Add data to the summary for the primary direction
-                    cycle_summary['Start Time'].append(start_time)
-                    cycle_summary['Cycle ID'].append(cycle_id)
-                    cycle_summary['Direction'].append(primary_direction)
-                    cycle_summary['Cycle Length'].append(cycle_length)
-                    cycle_summary['Split Length'].append(split_length_primary_to_opposite)
-                    cycle_summary['Green Time'].append(green_time_primary)
-                    cycle_summary['Red Time'].append(red_time_primary)
-                    cycle_summary['All Red Time'].append(all_red_time_primary_to_opposite)
-
-                    # Add data to the summary for the opposite direction
-                    cycle_summary['Start Time'].append(start_time)
-                    cycle_summary['Cycle ID'].append(cycle_id)
-                    cycle_summary['Direction'].append(opposite_direction)
-                    cycle_summary['Cycle Length'].append(cycle_length)
-                    cycle_summary['Split Length'].append(split_length_opposite_to_primary)
-                    cycle_summary['Green Time'].append(green_time_opposite)
-                    cycle_summary['Red Time'].append(red_time_opposite)
-                    cycle_summary['All Red Time'].append(all_red_time_opposite_to_primary)
-
-                else:
-                    # If data for a direction is missing, set values to NA (or None)
-                    cycle_summary['Start Time'].append(start_time)
-                    cycle_summary['Cycle ID'].append(cycle_id)
-                    cycle_summary['Direction'].append(primary_direction)
-                    cycle_summary['Cycle Length'].append(None)
-                    cycle_summary['Split Length'].append(None)
-                    cycle_summary['Green Time'].append(None)
-                    cycle_summary['Red Time'].append(None)
-                    cycle_summary['All Red Time'].append(None)
-
-                    # Also append NA for the opposite direction
-                    cycle_summary['Start Time'].append(start_time)
-                    cycle_summary['Cycle ID'].append(cycle_id)
-                    cycle_summary['Direction'].append(opposite_direction)
-                    cycle_summary['Cycle Length'].append(None)
-                    cycle_summary['Split Length'].append(None)
-                    cycle_summary['Green Time'].append(None)
-                    cycle_summary['Red Time'].append(None)
-                    cycle_summary['All Red Time'].append(None)
-
-    # Create a summary DataFrame
-    summary_df = pd.DataFrame(cycle_summary)
+    direction = df['Direction'].to_numpy()
+    i = np.arange(0, len(df), 2)
+    i = i[direction[i] == primary_direction]
+    cycle_id = np.arange(1, len(i) + 1)
+    in_range = i + 4 < len(df)
+    i, cycle_id = i[in_range], cycle_id[in_range]
+    complete = (direction[i + 2] == opposite_direction) & (direction[i + 4] == primary_direction)
+
+    # times of the cycle's 5 start/stop rows
+    timestamp = df['Timestamp'].to_numpy()
+    seconds = lambda later, earlier: pd.TimedeltaIndex(timestamp[later] - timestamp[earlier]).total_seconds().to_numpy()
+
+    # Calculate cycle length, split lengths (primary to opposite, opposite to primary) and green times
+    cycle_length = seconds(i + 4, i)
+    split_length = np.column_stack([seconds(i + 2, i), seconds(i + 4, i + 2)])
+    green_time = np.column_stack([seconds(i + 1, i), seconds(i + 3, i + 2)])
+    # Calculate red times and all red times
+    red_time = cycle_length[:, None] - green_time
+    all_red_time = split_length - green_time
+    # volume and average headway of the primary and opposite runs of the cycle
+    runs = pd.MultiIndex.from_arrays([np.column_stack([direction[i], direction[i + 2]]).ravel(),
+                                      np.column_stack([start_run[i], start_run[i + 2]]).ravel()])
+    cycle_runs = run_summary.reindex(runs)
+
+    # One row per cycle and direction (primary then opposite), NA when the cycle is incomplete
+    na_if_incomplete = lambda values: np.where(np.repeat(complete, 2), np.asarray(values, dtype=float).ravel(), np.nan)
+    summary_df = pd.DataFrame({
+        'Start Time': np.repeat(df['Time Stamp'].to_numpy()[i], 2),
+        'Cycle ID': np.repeat(cycle_id, 2),
+        'Direction': np.tile([primary_direction, opposite_direction], len(i)),
+        'Cycle Length': na_if_incomplete(np.repeat(cycle_length, 2)),
+        'Split Length': na_if_incomplete(split_length),
+        'Green Time': na_if_incomplete(green_time),
+        'Red Time': na_if_incomplete(red_time),
+        'All Red Time': na_if_incomplete(all_red_time),
+        'Volume': na_if_incomplete(cycle_runs['Volume'].fillna(0)),
+        'Average Headway': na_if_incomplete(cycle_runs['Average Headway'])})
 
     return df, summary_df # df is the raw cycle data, results I also want to be a df (not a dictionary) and to be the summary table
 
@@ -636,6 +475,8 @@ if __name__ == "__main__":
     # Create the output data file name by appending .xlsx to the folder name
     output_file = os.path.join(output_folder, f"{folder_name}.xlsx")
     print(f"The output file will be saved as: {output_file}")
+    # The typed analysis tables (count, headway and cycle tables) go to the flagging store; the .xlsx is an export
+    store_folder = os.path.join(output_folder, "store")
     headway_visualization = os.path.join(output_folder, f"{folder_name}_timeline.html")
     output_map = os.path.join(output_folder, f"{folder_name}_map.html")
     speed_limit_str = input("What is the speed limit (mph): ").strip()
@@ -711,6 +552,10 @@ if __name__ == "__main__":
     cycle_data, cycle_results = process_cycles(count_data)
 
 
+    # Write the count, headway and cycle tables to the flagging store
+    for table, data in [('counts', count_data), ('headway', headway_data), ('cycles', cycle_results)]:
+        write_table(data, store_folder, table, folder_name)
+    print(f"Analysis tables were written to the store '{store_folder}'.")
 
     # # Create an Excel writer
     with pd.ExcelWriter(output_file, engine='xlsxwriter') as writer:
@@ -1,17 +1,23 @@
 # all the import libraries here
 import os
 import xml.etree.ElementTree as ET
-import math
 from datetime import datetime
-from openpyxl import load_workbook
-import gpxpy
-from geopy import distance
 import pandas as pd
 import numpy as np
 import pytz
 from fastkml import kml
 import zipfile
 import sys
+import argparse
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Shared columnar GPX tracks live with the GPXReader tools
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'GPXReader'))
+from gpx_tracks import Track, IntersectionIndex, hit_pairs, haversine, bearing, MPS_TO_MPH
+from flagging_counts import clean_counts, read_count_files
+from flagging_store import write_table
+
 # INPUTS... folder name or raw files... maybe this will just loop through the folders in the folder path...
 # needs two counts folders (one in each direction), GPX, KML, and a csv/txt with the route info (speed limit, multiple access, pilot car)
 # KML needs to have the direction in the name
@@ -40,134 +46,52 @@ def read_files(folder_path):
                 files['xlsm2'] = file_path
     return files
 
-def parse_xlsm(xlsm_file):
-    wb = load_workbook(xlsm_file, read_only=True, keep_links=False)
-    sheet = wb.active
-    data = []
-    for row in sheet.iter_rows(min_row=1, max_col=3, values_only=True):
-        data.append(row)
-    return data
-
-# Haversine formula to calculate distance between two points on Earth
-def haversine(lat1, lon1, lat2, lon2):
-    R = 6371000  # Earth radius in meters
-    
-    dlat = np.radians(lat2 - lat1)
-    dlon = np.radians(lon2 - lon1)
-    
-    a = np.sin(dlat / 2) ** 2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(dlon / 2) ** 2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
-    
-    distance = R * c  # in meters
-    return distance
-
-# Function to calculate the bearing between two points
-def calculate_bearing(lat1, lon1, lat2, lon2):
-    lat1 = math.radians(lat1)
-    lon1 = math.radians(lon1)
-    lat2 = math.radians(lat2)
-    lon2 = math.radians(lon2)
-
-    dlon = lon2 - lon1
-    x = math.sin(dlon) * math.cos(lat2)
-    y = math.cos(lat1) * math.sin(lat2) - (math.sin(lat1) * math.cos(lat2) * math.cos(dlon))
-    initial_bearing = math.atan2(x, y)
-
-    # Convert bearing from radians to degrees
-    initial_bearing = math.degrees(initial_bearing)
-    compass_bearing = (initial_bearing + 360) % 360
-
-    return compass_bearing
-
-# Function to convert bearing to compass direction
+# Function to convert bearings (degrees) to compass directions
 def bearing_to_direction(bearing):
-    if 45 <= bearing < 135:
-        return 'EB'
-    elif 135 <= bearing < 225:
-        return 'SB'
-    elif 225 <= bearing < 315:
-        return 'WB'
-    else:
-        return 'NB'
+    return np.select(
+        [(45 <= bearing) & (bearing < 135), (135 <= bearing) & (bearing < 225), (225 <= bearing) & (bearing < 315)],
+        ['EB', 'SB', 'WB'],
+        default='NB')
 
 # Function to parse GPX file and calculate speed (and grade) returns a df
 def parse_gpx_file(gpx_file, intersections, route_name):
-    gpx_data = []
-    # Parse the GPX file
-    with open(gpx_file, 'r') as gpx_file:
-        gpx = gpxpy.parse(gpx_file)
-        # Extract data from GPX
-        for track in gpx.tracks:
-            for segment in track.segments:
-                for point in segment.points:
-                    # Convert UTC time to local time
-                    local_time = point.time.replace(tzinfo=pytz.UTC).astimezone(LOCAL_TZ)
-                    gpx_data.append({
-                        'lat': point.latitude, 
-                        'lon': point.longitude, 
-                        'time': local_time.strftime('%Y-%m-%dT%H:%M:%S'),
-                        'elevation': point.elevation
-                        })
-
-    # Initialize variables
-    output_data = []  # Initialize output data list
-    prev_intersection = None  # Initialize previous intersection
-
-    # Iterate through each point in GPX data
-    for point in gpx_data:
-        closest_intersection = None
-        # Iterate through each significant intersection
-        for intersection in intersections:
-            # Calculate the distance between the current point and the intersection
-            distance = haversine(point['lat'], point['lon'], intersection['lat'], intersection['lon'])
-            # Check if the distance is within the threshold (50 feet)
-            if distance <= 30:  # 100 feet in meters
-                closest_intersection = intersection
-                # Assign the time and elevation of the current point to the closest intersection
-                closest_intersection['time'] = point['time']
-                closest_intersection['elevation'] = point['elevation']
-                break  # Exit the loop if a significant intersection is found within the threshold
-
-        # If a closest intersection is found within the threshold, process it
-        if closest_intersection:
-            if prev_intersection:
-                # Calculate total distance between the previous intersection and the current closest intersection
-                total_distance = haversine(prev_intersection['lat'], prev_intersection['lon'], closest_intersection['lat'], closest_intersection['lon'])
-                
-                # Calculate the bearing between the previous intersection and the current closest intersection
-                bearing = calculate_bearing(prev_intersection['lat'], prev_intersection['lon'], closest_intersection['lat'], closest_intersection['lon'])
-                
-                # Convert the bearing to a compass direction
-                direction = bearing_to_direction(bearing)
-                
-                # Calculate time difference in seconds
-                time_diff = (datetime.strptime(closest_intersection['time'], '%Y-%m-%dT%H:%M:%S') - datetime.strptime(prev_intersection['time'], '%Y-%m-%dT%H:%M:%S')).total_seconds()
-                
-                # Calculate average speed (m/s) and convert to mph
-                avg_speed = (total_distance / time_diff) * 2.23694 if time_diff != 0 else 0
-                
-                # Calculate elevation difference
-                elevation_diff = closest_intersection['elevation'] - prev_intersection['elevation']
-                
-                # Calculate average grade
-                avg_grade = (elevation_diff / total_distance) * 100 if total_distance != 0 else 0
-                
-                # Store the segment start, segment finish, average speed, average grade, total distance, and direction in the output data
-                output_data.append({
-                    'route_name': route_name,
-                    'segment_ID': prev_intersection['pin_id'] + ' / ' + closest_intersection['pin_id'], 
-                    'segment_start': prev_intersection['segment_id'], 
-                    'segment_finish': closest_intersection['segment_id'], 
-                    'avg_speed': avg_speed, # mph
-                    'avg_grade': avg_grade, # percent
-                    'total_distance': total_distance * 0.000621371, # convert to miles
-                    'start_time': prev_intersection['time'], 
-                    'end_time': closest_intersection['time'],
-                    'Direction': direction})  # Add direction to the output data
-            prev_intersection = closest_intersection
-
-    # Convert output data to DataFrame
-    output_df = pd.DataFrame(output_data)
+    # Parse the GPX file into columnar arrays
+    track = Track.from_gpx(gpx_file)
+
+    # Find the first significant intersection within 30 m (100 feet) of every point, then pair consecutive hits
+    matches = IntersectionIndex(intersections, 30).match(track.lat, track.lon)
+    _, start_point, point, prev_intersection, intersection = hit_pairs(matches)
+
+    pin_ids = np.array([i['pin_id'] for i in intersections], dtype=object)
+    segment_ids = np.array([i['segment_id'] for i in intersections], dtype=object)
+    lat = np.array([i['lat'] for i in intersections], dtype=np.float64)
+    lon = np.array([i['lon'] for i in intersections], dtype=np.float64)
+
+    # Calculate total distance and bearing between the previous intersection and the current closest intersection
+    total_distance = haversine(lat[prev_intersection], lon[prev_intersection], lat[intersection], lon[intersection])
+    direction = bearing_to_direction(bearing(lat[prev_intersection], lon[prev_intersection], lat[intersection], lon[intersection]))
+
+    # Calculate time difference in whole seconds from integer epoch times (time stamps have always been read to the second)
+    seconds = track.epoch_seconds()
+    time_diff = seconds[point] - seconds[start_point]
+
+    # Calculate average speed (m/s) and convert to mph
+    avg_speed = np.divide(total_distance, time_diff, out=np.zeros(len(point)), where=time_diff != 0) * MPS_TO_MPH
+
+    # Calculate average grade from the elevation difference
+    elevation_diff = track.elevation[point] - track.elevation[start_point]
+    avg_grade = np.divide(elevation_diff, total_distance, out=np.zeros(len(point)), where=total_distance != 0) * 100
+
+    # Store the segment start, segment finish, average speed, average grade, total distance, and direction in the output data
+    output_df = pd.DataFrame({
+        'route_name': route_name,
+        'segment_ID': pin_ids[prev_intersection] + ' / ' + pin_ids[intersection],
+        'segment_start': segment_ids[prev_intersection],
+        'segment_finish': segment_ids[intersection],
+        'avg_speed': avg_speed, # mph
+        'avg_grade': avg_grade, # percent
+        'total_distance': total_distance * 0.000621371, # convert to miles
+        'Direction': direction})
     # filter out any rows where segment_start and segment_finish are the same
     output_df = output_df[output_df['segment_start'] != output_df['segment_finish']]
     # filter out any rows where segment_finish contains 'Queue' or 'queue'
@@ -179,26 +103,35 @@ def parse_gpx_file(gpx_file, intersections, route_name):
         'total_distance': 'mean'
     }).reset_index()
     # create new column for segment_type where if segment_ID contains 'Queue' or 'queue' then segment_type = 'Queue' else segment_type = 'Segment'
-    output_df['segment_type'] = output_df['segment_ID'].str.contains('Queue|queue', case=False).apply(lambda x: 'Queue' if x else 'Segment').reset_index(drop=True)
-    # group by route_id and direction and then create column for average speed in queue, average speed in segment, average grade (weighted by distance), total distance in segment
-    grouped_df = output_df.groupby(['route_name', 'Direction'])
-
-    avg_speed_queue = grouped_df.apply(lambda x: x[x['segment_type'] == 'Queue']['avg_speed']).reset_index(name='avg_speed_queue')
-    avg_speed_segment = grouped_df.apply(lambda x: x[x['segment_type'] == 'Segment']['avg_speed']).reset_index(name='avg_speed_segment')
-
-    # Calculate average grade (weighted by distance)
-    avg_grade_weighted = grouped_df.apply(lambda x: np.average(x['avg_grade'], weights=x['total_distance'])).reset_index(name='avg_grade_weighted')
-
-    # Calculate total distance in segment
-    total_distance_segment = grouped_df.apply(lambda x: x[x['segment_type'] == 'Segment']['total_distance']).reset_index(name='total_distance_segment')
-
-    # Merge all the calculated columns into a single DataFrame
-    final_df = avg_speed_queue.merge(avg_speed_segment, on=['route_name', 'Direction'])
-    final_df = final_df.merge(avg_grade_weighted, on=['route_name', 'Direction'])
-    final_df = final_df.merge(total_distance_segment, on=['route_name', 'Direction'])
-
-    # if the dataframe contains columns with 'level' in the name, drop them
-    final_df = final_df[[col for col in final_df.columns if 'level' not in col]]
+    is_queue = output_df['segment_ID'].str.contains('Queue|queue', case=False).to_numpy()
+    output_df['segment_type'] = np.where(is_queue, 'Queue', 'Segment')
+
+    # group by route_id and direction and then create columns for average speed in queue, average speed in segment,
+    # average grade (weighted by distance) and total distance in segment, all in one pass of named aggregations:
+    # the queue/segment columns are masked to NaN outside their segment type (NaN is skipped by mean/count), and the
+    # weighted grade is sum(grade * distance) / sum(distance)
+    features = pd.DataFrame({
+        'route_name': output_df['route_name'],
+        'Direction': output_df['Direction'],
+        'queue_speed': output_df['avg_speed'].where(is_queue),
+        'segment_speed': output_df['avg_speed'].where(~is_queue),
+        'grade_distance': output_df['avg_grade'] * output_df['total_distance'],
+        'total_distance': output_df['total_distance'],
+        'segment_distance': output_df['total_distance'].where(~is_queue)})
+    final_df = features.groupby(['route_name', 'Direction'], sort=True).agg(
+        avg_speed_queue=('queue_speed', 'mean'),
+        avg_speed_segment=('segment_speed', 'mean'),
+        grade_distance=('grade_distance', 'sum'),
+        distance=('total_distance', 'sum'),
+        total_distance_segment=('segment_distance', 'sum'),
+        segments=('segment_distance', 'count')).reset_index()
+
+    # Calculate average grade (weighted by distance), NaN when the group has no distance
+    final_df['avg_grade_weighted'] = final_df['grade_distance'] / final_df['distance'].where(final_df['distance'] != 0)
+    # Total distance in segment, NaN for a direction with no non-queue segment
+    final_df['total_distance_segment'] = final_df['total_distance_segment'].where(final_df['segments'] > 0)
+
+    final_df = final_df[['route_name', 'Direction', 'avg_speed_queue', 'avg_speed_segment', 'avg_grade_weighted', 'total_distance_segment']]
 
     return final_df
 
@@ -253,47 +186,10 @@ def parse_kml(folder):
                             
     return intersections
 
-# function that cleans the excel files
-def clean_xlsm(filename, route_name):
-    # Read the Excel file into a dataframe
-    df = pd.read_excel(filename)
-    # keep only the first 3 columns
-    df = df.iloc[:, :3]
-    
-    # Filter out invalid segments between multiple 'Start's without an intervening 'Stop'
-    segments = []
-    start_idx = None
-    valid_segment = True
-
-    for i, row in df.iterrows():
-        if row['Vehicle'] == 'Start':
-            if start_idx is not None:
-                # Exclude the segment if 'Start' is immediately followed by 'Stop'
-                if i == start_idx + 1 and df.loc[i, 'Vehicle'] == 'Stop':
-                    start_idx = None
-                    valid_segment = False
-                    continue
-            start_idx = i
-            valid_segment = True
-        elif row['Vehicle'] == 'Stop':
-            if start_idx is not None:
-                # Include only segments with valid data between 'Start' and 'Stop'
-                if valid_segment:
-                    segments.append(df.loc[start_idx:i])
-            start_idx = None
-            valid_segment = False
-
-    # Concatenate valid segments into a single DataFrame
-    if segments:
-        cleaned = pd.concat(segments)
-    else:
-        cleaned = pd.DataFrame(columns=df.columns)
-
-    # remove consecutive start-stops
-    drop_rows = cleaned[(cleaned['Vehicle'] == 'Start') & (cleaned['Vehicle'].shift(-1) == 'Stop')].index
-    drop_rows = drop_rows.union(drop_rows+1)
-
-    cleaned = cleaned.drop(drop_rows)
+# function that cleans a count sheet (Time Stamp, Vehicle, Direction) read from an excel file
+def clean_xlsm(df, route_name):
+    # Keep the valid Start...Stop segments and remove consecutive start-stops
+    cleaned = clean_counts(df)
 
     #remove rows with nan in the Vehicle column
     cleaned = cleaned[cleaned['Vehicle'].notna()]
@@ -311,15 +207,19 @@ def time_to_datetime(t):
     return datetime.combine(datetime.today(), t)
 
 # generate counts from the xlsm files
-def generate_counts(xlsm_files, route_name):
+# workers is the number of processes used to parse the xlsm files (None = one per CPU core)
+def generate_counts(xlsm_files, route_name, workers=None):
     # Initialize empty lists to hold data for counts and splits
     counts_data = []
     splits_data = []
     hourly_data = []
     
-    for file in xlsm_files:
-        # Read the XLSM file
-        df = clean_xlsm(file, route_name)
+    # Read the XLSM files (in parallel, through the parsed-counts cache)
+    count_sheets = read_count_files(xlsm_files, workers)
+
+    for count_sheet in count_sheets:
+        # Clean the count sheet
+        df = clean_xlsm(count_sheet, route_name)
 
         # Calculate headway here
         # Convert 'time stamp' to datetime for continuous axis plotting
@@ -449,9 +349,11 @@ def generate_counts(xlsm_files, route_name):
 #!!!# Loop through each folder, join tables, append to overall data table (splits)
 # test that the data is clean (start, stop, etc. not repeating start, start, etc.) and give warning that the data needs to be reviewed. Or warn that directions were skipped...?
 
-def process_folder(folder_path):
+# process one site folder (GPX, KML and two xlsm count files) into its regression table
+# route_name defaults to the folder's name
+def process_folder(folder_path, workers=None, route_name=None):
     files = read_files(folder_path)
-    route_name = os.path.basename(folder_path)
+    route_name = route_name or os.path.basename(os.path.normpath(folder_path))
     print(f'Processing route: {route_name}')
 
     # parse the kml file and get the intersections
@@ -462,7 +364,7 @@ def process_folder(folder_path):
 
     # parse the xlsm files and generate counts, splits, and volumes, etc.
     xlsm_files = [files['xlsm1'], files['xlsm2']]
-    counts_df, splits_df, hourly_df = generate_counts(xlsm_files, route_name)
+    counts_df, splits_df, hourly_df = generate_counts(xlsm_files, route_name, workers)
 
     # Merge gpx_df, counts_df, and hourly_df into splits_df by route_name and Direction
     merged_df = pd.merge(splits_df.reset_index(), gpx_df, on=['route_name', 'Direction'], how='left')
@@ -475,35 +377,133 @@ def process_folder(folder_path):
 
     return merged_df
 
+# Function to find the site folders under a root folder: any folder (at any depth) with a GPX file, a KML/KMZ file
+# and at least two xlsm count files
+def find_site_folders(root):
+    site_folders = []
+    for folder_path, folder_names, filenames in os.walk(root):
+        folder_names.sort()
+        extensions = [os.path.splitext(filename)[1].lower() for filename in filenames]
+        if '.gpx' in extensions and ('.kml' in extensions or '.kmz' in extensions) and extensions.count('.xlsm') >= 2:
+            site_folders.append(folder_path)
+    return site_folders
+
+# Function to name each site (the route_name in the tables and the site's file in the flagging store).
+# Sites found under --root are named by their path below it ('2023/US-6' -> '2023_US-6'), other folders by their
+# own name. Raises ValueError when two folders would get the same name.
+def site_names(folder_paths, root=None):
+    names = []
+    for folder_path in folder_paths:
+        folder_path = os.path.normpath(folder_path)
+        relative = os.path.relpath(folder_path, os.path.normpath(root)) if root else os.curdir
+        if relative == os.curdir or relative.startswith(os.pardir):
+            names.append(os.path.basename(os.path.abspath(folder_path)))
+        else:
+            names.append(relative.replace(os.sep, '_'))
+
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        clashes = '; '.join(f"{name}: " + ', '.join(path for path, n in zip(folder_paths, names) if n == name)
+                            for name in duplicates)
+        raise ValueError(f"Site folders with the same name (use --root to name them by their path): {clashes}")
+    return names
+
+# Function to process one site for the batch.
+# Returns (merged_df, seconds, error) so one bad site doesn't stop the batch
+def process_site(folder_path, route_name=None):
+    start = time.perf_counter()
+    try:
+        # the sites are already spread over the processes, so each site reads its count files serially
+        merged_df = process_folder(folder_path, workers=1, route_name=route_name)
+        return merged_df, time.perf_counter() - start, None
+    except Exception as e:
+        return None, time.perf_counter() - start, f"{type(e).__name__}: {e}"
+
+# Function to process every site folder, optionally across a pool of processes (workers=0 uses one per CPU core).
+# Sites come back in the order given for any worker count. Returns the combined table and a per-site log.
+def process_sites(folder_paths, workers=0, route_names=None):
+    route_names = route_names or [None] * len(folder_paths)
+    if workers == 1 or len(folder_paths) <= 1:
+        outcomes = [process_site(folder_path, route_name) for folder_path, route_name in zip(folder_paths, route_names)]
+    else:
+        with ProcessPoolExecutor(max_workers=workers or None) as executor:
+            outcomes = list(executor.map(process_site, folder_paths, route_names))
+
+    tables = []
+    site_log = []
+    for folder_path, (merged_df, seconds, error) in zip(folder_paths, outcomes):
+        if error is None:
+            tables.append(merged_df)
+        else:
+            print(f"Failed to process {folder_path}: {error}")
+        site_log.append({'site': folder_path, 'seconds': round(seconds, 3),
+                         'rows': 0 if merged_df is None else len(merged_df), 'error': error})
+    failures = sum(entry['error'] is not None for entry in site_log)
+    print(f"Processed {len(tables)} of {len(folder_paths)} sites ({failures} failed).")
+
+    total_merged_df = pd.concat(tables, ignore_index=True) if tables else pd.DataFrame()
+    return total_merged_df, pd.DataFrame(site_log, columns=['site', 'seconds', 'rows', 'error'])
+
+# Function to read the command line options. Without --root or --folders the folders are prompted for
+def parse_args():
+    parser = argparse.ArgumentParser(description="Build the one-way flagging regression table from site folders.")
+    parser.add_argument('--root', help="process every site folder (GPX, KML/KMZ and two .xlsm files) found under this folder")
+    parser.add_argument('--folders', help="comma-separated site folders (e.g. US-6,SR-40)")
+    parser.add_argument('--output', default="total_regression_table.csv", help="combined regression table (default total_regression_table.csv)")
+    parser.add_argument('--store', default="flagging_store", help="flagging store the typed regression table is written to, one file per site (default flagging_store)")
+    parser.add_argument('--workers', type=int, default=0, help="number of processes for the sites (default 0 = one per CPU core)")
+    return parser.parse_args()
+
 def main():
-    print("Welcome to the regression table builder.")
-    print("Please enter the names of the folders you want to analyze.")
-    print("Enter each folder name separated by commas (e.g., US-6, SR-40, ...).")
-    print("Press Enter when you're done.")
+    args = parse_args()
+
+    if args.root:
+        folder_names = find_site_folders(args.root)
+        print(f"Found {len(folder_names)} site folders under {args.root}.")
+    elif args.folders:
+        folder_names = [name.strip() for name in args.folders.split(',') if name.strip()]
+    else:
+        print("Welcome to the regression table builder.")
+        print("Please enter the names of the folders you want to analyze.")
+        print("Enter each folder name separated by commas (e.g., US-6, SR-40, ...).")
+        print("Press Enter when you're done.")
 
-    folder_input = input("Folders to analyze: ")
-    folder_names = [name.strip() for name in folder_input.split(',')]
+        folder_input = input("Folders to analyze: ")
+        folder_names = [name.strip() for name in folder_input.split(',') if name.strip()]
 
     if not folder_names:
         print("No folders specified. Exiting.")
         sys.exit(1)
 
-    total_merged_df = pd.DataFrame()
-
+    folder_paths = []
     for folder_name in folder_names:
         #folder_path = os.path.join("regression_input", folder_name)
         folder_path = folder_name
         if not os.path.isdir(folder_path):
             print(f"Warning: {folder_path} is not a valid directory. Skipping.")
             continue
+        folder_paths.append(folder_path)
+
+    try:
+        route_names = site_names(folder_paths, args.root)
+    except ValueError as e:
+        print(e)
+        sys.exit(1)
 
-        merged_df = process_folder(folder_path)
-        total_merged_df = pd.concat([total_merged_df, merged_df], ignore_index=True)
+    total_merged_df, site_log = process_sites(folder_paths, args.workers, route_names)
 
-    # Write the total_merged_df to a csv file
-    output_file = "total_regression_table.csv"
+    # Write the total_merged_df to a csv file, and the per-site timing and failures next to it
+    output_file = args.output
     total_merged_df.to_csv(output_file, index=False)
     print(f"Total regression table written to {output_file}")
+    # Write each site's table to the flagging store (what the modelling scripts read)
+    if len(total_merged_df):
+        for route_name, site_df in total_merged_df.groupby('route_name', sort=False):
+            write_table(site_df, args.store, 'regression', route_name)
+        print(f"Regression tables written to the store {args.store}")
+    log_file = os.path.splitext(output_file)[0] + '_sites.csv'
+    site_log.to_csv(log_file, index=False)
+    print(f"Per-site timing and failures written to {log_file}")
 
 if __name__ == "__main__":
     main()
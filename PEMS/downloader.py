@@ -2,13 +2,18 @@
 import os
 from dataclasses import dataclass
 from datetime import datetime, date, timedelta
+from io import BytesIO
+import numpy as np
 import pandas as pd
 import requests
+import requests.adapters
 from pathlib import Path
 import logging
-from typing import List, Optional
+from typing import Dict, Iterator, List, Optional
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
+import threading
+import importlib.util
 from tqdm import tqdm
 
 @dataclass
@@ -21,6 +26,7 @@ class ConfigSettings:
     granularity: str
     session_id: str
     directory_name: str
+    export_format: str = 'xls'  # 'xls' or 'text' (tab-separated) export from the server
 
     @classmethod
     def from_csv(cls, config_file: str) -> 'ConfigSettings':
@@ -36,12 +42,56 @@ class ConfigSettings:
                 second_param=row['Variable'],
                 granularity=row['Gran'],
                 session_id=f"PHPSESSID={row['PHP']}",
-                directory_name=row['Directory']
+                directory_name=row['Directory'],
+                export_format=row['Export'] if pd.notna(row.get('Export')) else 'xls'
             )
         except Exception as e:
             logging.error(f"Failed to read config file: {e}")
             raise
 
+# Fastest installed engine for Excel exports: calamine (Rust) reads .xlsx and .xls many times faster than
+# openpyxl/xlrd; without it the pure-Python readers are used
+EXCEL_ENGINE = 'calamine' if importlib.util.find_spec('python_calamine') else None
+
+
+# Per-lane columns of an export, e.g. '1234 Lane 2 Flow' and '1234 Lane 2 Speed - Used in Calculations'
+LANE_COLUMN = r'^(?P<station>\d+) Lane (?P<lane>\d+) (?P<measure>Flow|Speed - Used in Calculations)$'
+
+
+def decode_export(content: bytes) -> pd.DataFrame:
+    """Decode an exported chunk, whatever format the server answered with.
+
+    Text exports (tab- or comma-separated) are read with the C CSV parser, .xlsx/.xls workbooks with the
+    fastest installed Excel engine and HTML tables with read_html. 'Sample Time' is returned as datetimes.
+    """
+    head = content[:8]
+    if head.startswith(b'PK'):  # .xlsx (zip)
+        df = pd.read_excel(BytesIO(content), engine=EXCEL_ENGINE or 'openpyxl')
+    elif head.startswith(b'\xd0\xcf\x11\xe0'):  # legacy .xls (OLE2)
+        df = pd.read_excel(BytesIO(content), engine=EXCEL_ENGINE or 'xlrd')
+    elif content.lstrip()[:1] == b'<':  # HTML table
+        df = pd.read_html(BytesIO(content))[0]
+    else:
+        first_line = content.split(b'\n', 1)[0]
+        df = pd.read_csv(BytesIO(content), sep='\t' if b'\t' in first_line else ',')
+
+    if 'Sample Time' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['Sample Time']):
+        df['Sample Time'] = pd.to_datetime(df['Sample Time'], format='mixed')
+    return df
+
+
+def parquet_ready(df: pd.DataFrame) -> pd.DataFrame:
+    """Make the columns of a raw export storable as Parquet (numbers as numbers, mixed values as strings)."""
+    df = df.copy()
+    df.columns = [str(column) for column in df.columns]
+    for column in df.columns[df.dtypes == object]:
+        try:
+            df[column] = pd.to_numeric(df[column])
+        except (ValueError, TypeError):
+            df[column] = df[column].astype(str).where(df[column].notna())
+    return df
+
+
 class PeMSCollector:
     """Handles collection of PeMS traffic data."""
     
@@ -49,8 +99,9 @@ class PeMSCollector:
     MONTH_NAMES = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
                    'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
 
-    def __init__(self, config: ConfigSettings):
+    def __init__(self, config: ConfigSettings, base_url: Optional[str] = None):
         self.config = config
+        self.base_url = base_url or self.BASE_URL
         self.session = requests.Session()
         self._setup_session()
         Path(config.directory_name).mkdir(parents=True, exist_ok=True)
@@ -80,11 +131,12 @@ class PeMSCollector:
         }.get(self.config.granularity, 92)  # default to 92 days
 
     def _create_filename(self, start_date: date, end_date: date, station: int) -> str:
-        """Generate filename for the data file."""
-        return (f"{self.config.directory_name}/"
+        """Generate filename for the raw data file of a chunk (unique per station, date range, granularity and
+        second variable, since the export depends on all of them)."""
+        return (f"{self.config.directory_name}/raw/"
                 f"{self.MONTH_NAMES[start_date.month - 1]}-{start_date.day:02d}-{start_date.year}_"
                 f"{self.MONTH_NAMES[end_date.month - 1]}-{end_date.day:02d}-{end_date.year}_"
-                f"{self.config.granularity}_{station}.xlsx")
+                f"{self.config.granularity}_{self.config.second_param}_{station}.parquet")
 
     def _create_url_params(self, start_date: date, station: int, start_sec: int, end_sec: int) -> dict:
         """Create URL parameters for PeMS API request."""
@@ -93,7 +145,7 @@ class PeMSCollector:
             'dnode': 'VDS',
             'content': 'detector_health',
             'tab': 'dh_raw',
-            'export': 'xls',
+            'export': self.config.export_format,
             'station_id': station,
             's_time_id': start_sec,
             's_mm': start_date.month,
@@ -113,67 +165,102 @@ class PeMSCollector:
             'gn': self.config.granularity
         }
 
+    def _chunk_params(self, station: int, start_date: date, end_date: date) -> dict:
+        """Create the URL parameters for one station's date range."""
+        # Convert dates to Unix timestamps for the API request
+        start_sec = int(datetime.combine(start_date, datetime.min.time()).timestamp())
+        end_sec = int(datetime.combine(end_date, datetime.max.time()).timestamp())
+        return self._create_url_params(start_date, station, start_sec, end_sec)
+
     def collect_data(self, station: int, start_date: date, end_date: date) -> Optional[pd.DataFrame]:
         """Collect data for a specific station and date range and return as DataFrame."""
         try:
-            # Convert dates to Unix timestamps for the API request
-            start_sec = int(datetime.combine(start_date, datetime.min.time()).timestamp())
-            end_sec = int(datetime.combine(end_date, datetime.max.time()).timestamp())
-            
+            # Reuse the raw chunk if it was downloaded before
+            raw_data = self._load_raw_chunk(station, start_date, end_date)
+            if raw_data is not None:
+                return self._melt_lanes(station, raw_data)
+
             # Create parameters for the API request
-            params = self._create_url_params(start_date, station, start_sec, end_sec)
+            params = self._chunk_params(station, start_date, end_date)
             
             # Make the API request
-            response = self.session.get(self.BASE_URL, params=params)
+            response = self.session.get(self.base_url, params=params)
             response.raise_for_status()  # Raises an HTTPError for bad responses (4xx, 5xx)
-            
-            # Read Excel data from the response content
-            # BytesIO is needed because response.content is in bytes format
-            from io import BytesIO
-            df = pd.read_excel(BytesIO(response.content), engine='openpyxl')
 
-            # Write the response to a csv file
-            df.to_csv(f"{self.config.directory_name}/raw_data_{station}.csv", index=False)
-            
-            
-            all_data = []
-            
-            # Find available lanes by checking column names
-            # Some stations might not have all lanes, so we need to check which ones exist
-            available_lanes = []
-            for lane in range(1, 7):  # Check lanes 1-6
-                flow_col = f'{station} Lane {lane} Flow'
-                speed_col = f'{station} Lane {lane} Speed - Used in Calculations'
-                # Only include lanes that have both flow and speed data
-                if flow_col in df.columns and speed_col in df.columns:
-                    available_lanes.append(lane)
-            
-            # If no valid lanes found, log warning and skip this station
-            if not available_lanes:
-                logging.warning(f"No valid lanes found for station {station}")
-                return None
-            
-            # Process each available lane
-            for lane in available_lanes:
-                # Create a standardized DataFrame for each lane
-                # This makes it easier to combine data from multiple stations later
-                lane_data = pd.DataFrame({
-                    'StationID': station,
-                    'ReadingDateTime': df['Sample Time'],
-                    'Lane': lane,
-                    'Volume': df[f'{station} Lane {lane} Flow'],
-                    'Speed': df[f'{station} Lane {lane} Speed - Used in Calculations']
-                })
-                all_data.append(lane_data)
-            
-            # Combine all lanes into a single DataFrame
-            return pd.concat(all_data, ignore_index=True)
-            
+            return self._parse_chunk(station, start_date, end_date, response.content)
+
         except Exception as e:
             # Log any errors that occur during data collection
             logging.error(f"Failed to collect data for station {station}: {e}")
             return None
 
+    def _load_raw_chunk(self, station: int, start_date: date, end_date: date) -> Optional[pd.DataFrame]:
+        """Read a chunk's saved raw data (None when it has not been downloaded or the saved file is unreadable)."""
+        raw_file = Path(self._create_filename(start_date, end_date, station))
+        if not raw_file.exists():
+            return None
+        try:
+            return pd.read_parquet(raw_file)
+        except Exception as e:
+            # Download the chunk again rather than failing it on every run
+            logging.warning(f"Could not read raw chunk {raw_file} ({e}); downloading it again")
+            raw_file.unlink(missing_ok=True)
+            return None
+
+    def _save_raw_chunk(self, df: pd.DataFrame, station: int, start_date: date, end_date: date):
+        """Save a chunk's raw data as compressed Parquet under its own name (written to a temporary file first)."""
+        raw_file = Path(self._create_filename(start_date, end_date, station))
+        raw_file.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = raw_file.with_name(f"{raw_file.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            parquet_ready(df).to_parquet(tmp_file, index=False, compression='zstd')
+            os.replace(tmp_file, raw_file)
+        finally:
+            tmp_file.unlink(missing_ok=True)
+
+    def _parse_chunk(self, station: int, start_date: date, end_date: date, content: bytes) -> Optional[pd.DataFrame]:
+        """Decode one exported chunk, save its raw data and return its rows per lane."""
+        df = decode_export(content)
+        self._save_raw_chunk(df, station, start_date, end_date)
+        return self._melt_lanes(station, df)
+
+    def _melt_lanes(self, station: int, df: pd.DataFrame) -> Optional[pd.DataFrame]:
+        """Reshape a chunk's raw data into StationID, ReadingDateTime, Lane, Volume and Speed rows per lane.
+
+        The '{station} Lane N Flow' and '{station} Lane N Speed - Used in Calculations' columns are found with one
+        regex over the column names and every lane is reshaped at once (lane by lane, like stacking the lanes).
+        StationID is int32, Lane int8, Volume and Speed float32.
+
+        Returns None when the export has no lane with both flow and speed columns.
+        """
+        # Find available lanes by matching the column names
+        # Some stations might not have all lanes, so only lanes with both flow and speed data are kept
+        names = pd.Series(df.columns.astype(str))
+        parts = names.str.extract(LANE_COLUMN).assign(column=names)
+        parts = parts[parts['station'] == str(station)]
+        columns = parts.pivot_table(index='lane', columns='measure', values='column', aggfunc='first') if len(parts) else parts
+        columns = columns.reindex(columns=['Flow', 'Speed - Used in Calculations']).dropna()
+
+        # If no valid lanes found, log warning and skip this station
+        if columns.empty:
+            logging.warning(f"No valid lanes found for station {station}")
+            return None
+
+        columns = columns.set_axis(columns.index.astype(int)).sort_index()
+        lanes = columns.index.to_numpy()
+        rows = len(df)
+        volume = df[columns['Flow'].tolist()].apply(pd.to_numeric, errors='coerce')
+        speed = df[columns['Speed - Used in Calculations'].tolist()].apply(pd.to_numeric, errors='coerce')
+
+        # Stack the lanes: lane-major rows, each lane's column read straight out of the 2-D array
+        return pd.DataFrame({
+            'StationID': np.full(rows * len(lanes), station, dtype=np.int32),
+            'ReadingDateTime': np.tile(df['Sample Time'].to_numpy(), len(lanes)),
+            'Lane': np.repeat(lanes.astype(np.int8), rows),
+            'Volume': volume.to_numpy(dtype=np.float32, na_value=np.nan).ravel(order='F'),
+            'Speed': speed.to_numpy(dtype=np.float32, na_value=np.nan).ravel(order='F')
+        })
+
     def _get_date_chunks(self, start_date: date, end_date: date, chunk_size: int) -> List[tuple]:
         """Break the date range into chunks for parallel processing.
         
@@ -217,71 +304,140 @@ class PeMSCollector:
                         for c in data['completed_chunks']]
         return []
 
-    def run(self, stations: List[int], max_workers: int = 3) -> pd.DataFrame:
-        """Run the data collection process using parallel processing.
-        
+    def _mount_pool(self, max_workers: int):
+        """Size the session's connection pool so every worker thread can hold a connection."""
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(max_workers, 1))
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _pending_tasks(self, stations: List[int], chunk_size: int) -> Dict[int, tuple]:
+        """Get the chunks still to download for every station.
+
         Args:
             stations: List of station IDs to collect
-            max_workers: Maximum number of parallel threads (default: 3)
-        
+            chunk_size: Number of days per chunk
+
         Returns:
-            Combined DataFrame of all collected data
+            Dict of station ID -> (completed chunks, pending chunks), for stations with pending chunks
         """
-        all_data = []
-        chunk_size = self._get_increment()
-        
-        # Process each station
+        chunks = self._get_date_chunks(self.config.start_date, self.config.end_date, chunk_size)
+        tasks = {}
         for station in stations:
-            logging.info(f"Processing station {station}")
-            
-            # Load any previously completed chunks
+            # Load any previously completed chunks and filter them out
             completed_chunks = self._load_progress(station)
-            
-            # Get all chunks for the date range
-            chunks = self._get_date_chunks(self.config.start_date, self.config.end_date, chunk_size)
-            
-            # Filter out completed chunks
-            chunks = [c for c in chunks if c not in completed_chunks]
-            
-            if not chunks:
+            pending = [c for c in chunks if c not in completed_chunks]
+            if pending:
+                tasks[station] = (completed_chunks, pending)
+            else:
                 logging.info(f"Station {station} already completed")
-                continue
-            
-            station_data = []
-            
-            # Process chunks in parallel
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                # Create a progress bar
-                with tqdm(total=len(chunks), desc=f"Station {station}") as pbar:
-                    # Submit all chunks for processing
-                    future_to_chunk = {
-                        executor.submit(self.collect_data, station, chunk[0], chunk[1]): chunk 
-                        for chunk in chunks
-                    }
-                    
-                    # Process completed futures as they finish
-                    for future in as_completed(future_to_chunk):
-                        chunk = future_to_chunk[future]
-                        try:
-                            data = future.result()
-                            if data is not None:
-                                station_data.append(data)
-                                completed_chunks.append(chunk)
-                                self._save_progress(station, completed_chunks)
-                        except Exception as e:
-                            logging.error(f"Failed to process chunk {chunk}: {e}")
-                        pbar.update(1)
-            
-            # Combine all data for this station
-            if station_data:
-                station_df = pd.concat(station_data, ignore_index=True)
-                all_data.append(station_df)
-                
-                # Save intermediate results
-                station_file = Path(self.config.directory_name) / f"station_{station}_data.csv"
-                station_df.to_csv(station_file, index=False)
-                logging.info(f"Saved data for station {station} to {station_file}")
-        
+        return tasks
+
+    def _finish_station(self, station: int, station_data: List[pd.DataFrame], failed: int, total: int) -> Optional[pd.DataFrame]:
+        """Report a station whose chunks are all done and save its intermediate results."""
+        logging.info(f"Station {station} finished: {total - failed}/{total} chunks collected")
+        if not station_data:
+            return None
+        station_df = pd.concat(station_data, ignore_index=True)
+
+        # Save intermediate results
+        station_file = Path(self.config.directory_name) / f"station_{station}_data.csv"
+        station_df.to_csv(station_file, index=False)
+        logging.info(f"Saved data for station {station} to {station_file}")
+        return station_df
+
+    def _thread_results(self, tasks: Dict[int, tuple], max_workers: int) -> Iterator[tuple]:
+        """Download every pending chunk in one shared thread pool.
+
+        Yields:
+            (station, chunk, DataFrame or None, exception or None) as each chunk finishes
+        """
+        self._mount_pool(max_workers)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            # Submit every chunk of every station to the one pool
+            future_to_task = {
+                executor.submit(self.collect_data, station, chunk[0], chunk[1]): (station, chunk)
+                for station, (_, pending) in tasks.items()
+                for chunk in pending
+            }
+
+            # Process completed futures as they finish
+            for future in as_completed(future_to_task):
+                station, chunk = future_to_task.pop(future)
+                try:
+                    yield station, chunk, future.result(), None
+                except Exception as e:
+                    yield station, chunk, None, e
+
+    def run(self, stations: List[int], max_workers: int = 3, backend: str = 'threads', lake: Optional[str] = None,
+            **backend_options) -> pd.DataFrame:
+        """Run the data collection process using parallel processing.
+
+        Every (station, chunk) download goes into one shared pool, so the pool stays busy across stations
+        instead of draining a few chunks of one station at a time. Stations are submitted in order, so the
+        first stations finish (and are saved) first.
+
+        Args:
+            stations: List of station IDs to collect
+            max_workers: Maximum number of concurrent downloads across all stations (default: 3)
+            backend: 'threads' (requests session in a thread pool) or 'async' (aiohttp with a connection pool,
+                adaptive rate limiting and retries, see pems_async.AsyncBackend)
+            lake: Folder of a partitioned Parquet dataset (see pems_lake) that every chunk is written to as it
+                arrives; the chunks are then not kept in memory or written to station CSVs
+            **backend_options: Options for the async backend (rate, max_rate, max_retries, timeout)
+
+        Returns:
+            Combined DataFrame of all collected data (empty when the data goes to a lake; read it with
+            pems_lake.read_lake or pems_lake.iter_lake)
+        """
+        all_data = []
+        chunk_size = self._get_increment()
+        tasks = self._pending_tasks(stations, chunk_size)
+        if not tasks:
+            return pd.DataFrame()
+
+        if lake is not None:
+            from pems_lake import write_chunk
+
+        if backend == 'async':
+            from pems_async import AsyncBackend
+            results = AsyncBackend(self, concurrency=max_workers, **backend_options).results(tasks)
+        elif backend == 'threads':
+            results = self._thread_results(tasks, max_workers)
+        else:
+            raise ValueError(f"Unknown backend {backend!r} (expected 'threads' or 'async')")
+
+        station_data = {station: [] for station in tasks}
+        remaining = {station: len(pending) for station, (_, pending) in tasks.items()}
+        failed = {station: 0 for station in tasks}
+        stations_done = 0
+
+        # Create a progress bar over all chunks, reporting the stations done so far
+        with tqdm(total=sum(remaining.values()), desc="Chunks") as pbar:
+            for station, chunk, data, error in results:
+                completed_chunks = tasks[station][0]
+                if data is not None:
+                    if lake is not None:
+                        write_chunk(data, lake, chunk[0], chunk[1], self.config.granularity)
+                    else:
+                        station_data[station].append(data)
+                    completed_chunks.append(chunk)
+                    self._save_progress(station, completed_chunks)
+                else:
+                    failed[station] += 1
+                    if error is not None:
+                        logging.error(f"Failed to process chunk {chunk} of station {station}: {error}")
+                pbar.update(1)
+
+                # Combine all data for a station as soon as its last chunk is in
+                remaining[station] -= 1
+                if remaining[station] == 0:
+                    station_df = self._finish_station(station, station_data.pop(station), failed[station],
+                                                      len(tasks[station][1]))
+                    if station_df is not None:
+                        all_data.append(station_df)
+                    stations_done += 1
+                    pbar.set_postfix(stations=f"{stations_done}/{len(tasks)}")
+
         # Combine all station data
         if all_data:
             combined_df = pd.concat(all_data, ignore_index=True)
@@ -299,14 +455,11 @@ def main():
         config = ConfigSettings.from_csv("old/PeMS_config.csv")
         stations = PeMSCollector.read_stations("old/PeMS_Stations.csv")
         
-        # Collect and process data
+        # Collect the data straight into the partitioned Parquet lake (station/granularity/year/month/day)
         collector = PeMSCollector(config)
-        raw_data = collector.run(stations, max_workers=3)  # Adjust max_workers based on your system
-        
-        # Save final processed data
-        output_file = Path(config.directory_name) / "processed_data.csv"
-        raw_data.to_csv(output_file, index=False)
-        logging.info(f"Processed data saved to {output_file}")
+        lake = Path(config.directory_name) / "lake"
+        collector.run(stations, max_workers=3, lake=str(lake))  # Adjust max_workers based on your system
+        logging.info(f"Collected data saved to {lake} (read it with pems_lake.read_lake or query.process_traffic_lake)")
         
     except Exception as e:
         logging.error(f"Script failed: {e}")
@@ -0,0 +1,194 @@
+# pems_async.py
+"""Asyncio/aiohttp download backend for PeMSCollector.
+
+Chunks are fetched over one pooled aiohttp session. A token bucket limits the request rate: it halves the rate
+when the server answers 429 or 5xx (honouring Retry-After) and creeps back up after successful requests, so a
+bulk pull settles at the highest rate the server tolerates. Throttled and failed requests are retried with
+exponential backoff up to a bounded number of attempts. The base URL comes from the collector, so the backend
+can be pointed at a local stub server.
+"""
+import asyncio
+import logging
+import queue
+import random
+import threading
+from datetime import date, datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterator, Optional, Tuple
+
+import aiohttp
+
+
+class TokenBucket:
+    """Token-bucket rate limiter with multiplicative backoff and additive recovery."""
+
+    def __init__(self, rate: float, max_rate: Optional[float] = None, min_rate: float = 0.05,
+                 backoff: float = 0.5, recovery: float = 0.05):
+        """
+        Args:
+            rate: Starting request rate (requests per second); also the bucket size
+            max_rate: Highest rate recovery can reach (default: the starting rate)
+            min_rate: Lowest rate backoff can reach
+            backoff: Factor the rate is multiplied by when the server throttles
+            recovery: Requests per second added back after every successful request
+        """
+        self.rate = rate
+        self.max_rate = max_rate or rate
+        self.min_rate = min_rate
+        self.backoff = backoff
+        self.recovery = recovery
+        self._capacity = max(rate, 1.0)
+        self._tokens = self._capacity
+        self._updated: Optional[float] = None
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        if self._updated is not None:
+            self._tokens = min(self._capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self):
+        """Wait for a token (callers are served in order)."""
+        loop = asyncio.get_running_loop()
+        async with self._lock:
+            while True:
+                now = loop.time()
+                self._refill(now)
+                if now >= self._blocked_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep(max(self._blocked_until - now, (1 - self._tokens) / self.rate, 0.001))
+
+    def throttled(self, retry_after: Optional[float] = None):
+        """Back off after a 429/5xx response or a connection failure."""
+        self.rate = max(self.min_rate, self.rate * self.backoff)
+        self._tokens = min(self._tokens, 0.0)
+        if retry_after:
+            self._blocked_until = max(self._blocked_until, asyncio.get_running_loop().time() + retry_after)
+
+    def succeeded(self):
+        """Recover some rate after a successful request."""
+        self.rate = min(self.max_rate, self.rate + self.recovery)
+
+
+def retry_after_seconds(value: Optional[str]) -> Optional[float]:
+    """Parse a Retry-After header (seconds or an HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)  # a '-0000' zone parses as naive; HTTP dates are UTC
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class RetryableError(Exception):
+    """A response or connection failure worth retrying."""
+
+
+class AsyncBackend:
+    """Downloads PeMSCollector chunks with aiohttp."""
+
+    def __init__(self, collector, concurrency: int = 8, rate: float = 2.0, max_rate: Optional[float] = None,
+                 max_retries: int = 5, timeout: float = 300):
+        """
+        Args:
+            collector: PeMSCollector supplying the base URL, headers, request parameters, raw chunks and chunk parser
+            concurrency: Maximum number of requests in flight (and pooled connections)
+            rate: Starting request rate (requests per second)
+            max_rate: Highest request rate (default: 4x the starting rate)
+            max_retries: Retries per chunk after the first attempt
+            timeout: Total timeout of one request in seconds
+        """
+        self.collector = collector
+        self.concurrency = max(concurrency, 1)
+        self.rate = rate
+        self.max_rate = max_rate or rate * 4
+        self.max_retries = max_retries
+        self.timeout = timeout
+
+    async def _fetch(self, http: aiohttp.ClientSession, bucket: TokenBucket, params: dict) -> bytes:
+        """Fetch one export, retrying throttled and failed requests with exponential backoff."""
+        error: Exception = RetryableError("not attempted")
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                await asyncio.sleep(min(2 ** attempt, 60) * random.uniform(0.5, 1.0))
+            await bucket.acquire()
+            try:
+                async with http.get(self.collector.base_url, params=params) as response:
+                    if response.status == 429 or response.status >= 500:
+                        bucket.throttled(retry_after_seconds(response.headers.get('Retry-After')))
+                        error = RetryableError(f"HTTP {response.status}")
+                        continue
+                    response.raise_for_status()  # Other 4xx responses are not retried
+                    content = await response.read()
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as e:
+                bucket.throttled()
+                error = RetryableError(f"{type(e).__name__}: {e}")
+                continue
+            bucket.succeeded()
+            return content
+        raise RetryableError(f"gave up after {self.max_retries + 1} attempts ({error})")
+
+    async def _collect(self, tasks: Dict[int, tuple], results: queue.Queue):
+        """Fetch and parse every pending chunk, putting (station, chunk, data, error) on the results queue."""
+        loop = asyncio.get_running_loop()
+        bucket = TokenBucket(self.rate, self.max_rate)
+        in_flight = asyncio.Semaphore(self.concurrency)
+        connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.concurrency,
+                                         ttl_dns_cache=300, keepalive_timeout=60)
+
+        async def collect(http: aiohttp.ClientSession, station: int, chunk: Tuple[date, date]):
+            async with in_flight:
+                try:
+                    # Reuse the raw chunk if it was downloaded before
+                    raw_data = await loop.run_in_executor(None, self.collector._load_raw_chunk, station, chunk[0], chunk[1])
+                    if raw_data is not None:
+                        data = await loop.run_in_executor(None, self.collector._melt_lanes, station, raw_data)
+                    else:
+                        params = self.collector._chunk_params(station, chunk[0], chunk[1])
+                        content = await self._fetch(http, bucket, params)
+                        # Parse off the event loop so downloads keep flowing
+                        data = await loop.run_in_executor(None, self.collector._parse_chunk, station, chunk[0], chunk[1], content)
+                    results.put((station, chunk, data, None))
+                except Exception as e:
+                    results.put((station, chunk, None, e))
+
+        async with aiohttp.ClientSession(headers=dict(self.collector.session.headers), connector=connector,
+                                         timeout=aiohttp.ClientTimeout(total=self.timeout)) as http:
+            await asyncio.gather(*(collect(http, station, chunk)
+                                   for station, (_, pending) in tasks.items() for chunk in pending))
+        logging.info(f"Async backend finished at {bucket.rate:.2f} requests/s")
+
+    def results(self, tasks: Dict[int, tuple]) -> Iterator[tuple]:
+        """Run the downloads on an event loop in a background thread.
+
+        Yields:
+            (station, chunk, DataFrame or None, exception or None) as each chunk finishes
+        """
+        results: queue.Queue = queue.Queue()
+        done = object()
+        failure = []
+
+        def run_loop():
+            try:
+                asyncio.run(self._collect(tasks, results))
+            except BaseException as e:
+                failure.append(e)
+            finally:
+                results.put(done)
+
+        thread = threading.Thread(target=run_loop, name="pems-async", daemon=True)
+        thread.start()
+        while (item := results.get()) is not done:
+            yield item
+        thread.join()
+        if failure:
+            raise failure[0]
@@ -0,0 +1,143 @@
+# pems_lake.py
+"""Partitioned Parquet storage for PeMS downloads.
+
+Every downloaded chunk is written as it arrives to a hive-partitioned dataset:
+
+    <root>/StationID=<id>/granularity=<gran>/year=<yyyy>/month=<m>/<yyyymmdd>.parquet
+
+so nothing has to be held in memory until the end of a run. There is one file per station, granularity and day, and
+writing a chunk replaces the files of every day it covers, so downloading a range again (even with shifted chunk
+boundaries) never leaves duplicate rows behind. Reads go through a pyarrow dataset: a station / date range filter skips whole partition folders and, within
+the files, row groups outside the range, and iter_lake streams record batches for data larger than RAM.
+"""
+import os
+import threading
+from datetime import date, timedelta
+from typing import Iterable, Iterator, List, Optional
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+PARTITION_SCHEMA = pa.schema([('StationID', pa.int32()), ('granularity', pa.string()),
+                              ('year', pa.int16()), ('month', pa.int8())])
+LAKE_COLUMNS = ['ReadingDateTime', 'Lane', 'Volume', 'Speed']
+# Schema of an empty or missing lake, so reads of it return no rows instead of failing
+EMPTY_SCHEMA = pa.schema([('ReadingDateTime', pa.timestamp('us')), ('Lane', pa.int64()), ('Volume', pa.float64()),
+                          ('Speed', pa.float64())] + list(PARTITION_SCHEMA))
+
+
+def _day_path(root: str, station: int, granularity: str, day: date) -> str:
+    """Path of the file holding one station's rows of one day at one granularity."""
+    return os.path.join(root, f"StationID={station}", f"granularity={granularity}", f"year={day.year}",
+                        f"month={day.month}", f"{day:%Y%m%d}.parquet")
+
+
+def write_chunk(df: pd.DataFrame, root: str, start_date: date, end_date: date, granularity: str) -> List[str]:
+    """Write one station chunk (StationID, ReadingDateTime, Lane, Volume, Speed rows) to the lake.
+
+    The chunk is split into one file per station and day. Every day from start_date to end_date replaces what
+    the lake held for it before; days of the range without rows have their old file removed.
+
+    Returns:
+        Paths of the files written
+    """
+    paths = []
+    times = pd.to_datetime(df['ReadingDateTime'])
+    written = set()
+    for (station, day), part in df.groupby([df['StationID'], times.dt.date], sort=False):
+        path = _day_path(root, int(station), granularity, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            part[LAKE_COLUMNS].sort_values('ReadingDateTime', kind='stable').to_parquet(
+                tmp_path, index=False, compression='zstd', row_group_size=1 << 17)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        written.add((int(station), day))
+        paths.append(path)
+
+    # Drop what an earlier download left for the days this chunk came back empty
+    for station in {int(s) for s in df['StationID'].unique()}:
+        day = start_date
+        while day <= end_date:
+            path = _day_path(root, station, granularity, day)
+            if (station, day) not in written and os.path.exists(path):
+                os.remove(path)
+            day += timedelta(days=1)
+    return paths
+
+
+def lake_granularities(root: str) -> List[str]:
+    """Granularities present in the lake."""
+    if not os.path.isdir(root):
+        return []
+    return sorted({name.split('=', 1)[1]
+                   for station in os.listdir(root) if station.startswith('StationID=')
+                   for name in os.listdir(os.path.join(root, station)) if name.startswith('granularity=')})
+
+
+def lake_dataset(root: str) -> ds.Dataset:
+    """Open the lake as a pyarrow dataset (StationID, granularity, year and month come from the folder names)."""
+    if os.path.isdir(root):
+        dataset = ds.dataset(root, format='parquet', partitioning=ds.partitioning(PARTITION_SCHEMA, flavor='hive'))
+        if dataset.files:
+            return dataset
+    return ds.dataset([], schema=EMPTY_SCHEMA)
+
+
+def lake_filter(dataset: ds.Dataset, stations: Optional[Iterable[int]] = None,
+                start_date: Optional[date] = None, end_date: Optional[date] = None,
+                granularity: Optional[str] = None) -> Optional[ds.Expression]:
+    """Build the filter for some stations, an inclusive date range and a granularity (None means no limit).
+
+    The station, granularity and year/month terms prune partition folders; the ReadingDateTime terms prune
+    row groups.
+    """
+    terms = []
+    year, month = ds.field('year'), ds.field('month')
+    time_type = (dataset.schema.field('ReadingDateTime').type if 'ReadingDateTime' in dataset.schema.names
+                 else pa.timestamp('us'))
+    if stations is not None:
+        terms.append(ds.field('StationID').isin([int(s) for s in stations]))
+    if granularity is not None:
+        terms.append(ds.field('granularity') == granularity)
+    if start_date is not None:
+        terms.append((year > start_date.year) | ((year == start_date.year) & (month >= start_date.month)))
+        terms.append(ds.field('ReadingDateTime') >= pa.scalar(pd.Timestamp(start_date), type=time_type))
+    if end_date is not None:
+        terms.append((year < end_date.year) | ((year == end_date.year) & (month <= end_date.month)))
+        terms.append(ds.field('ReadingDateTime') < pa.scalar(pd.Timestamp(end_date + timedelta(days=1)), type=time_type))
+    if not terms:
+        return None
+    expression = terms[0]
+    for term in terms[1:]:
+        expression = expression & term
+    return expression
+
+
+def read_lake(root: str, stations: Optional[Iterable[int]] = None, start_date: Optional[date] = None,
+              end_date: Optional[date] = None, columns: Optional[List[str]] = None,
+              granularity: Optional[str] = None) -> pd.DataFrame:
+    """Read the rows of some stations and dates into one DataFrame (StationID, ReadingDateTime, Lane, Volume, Speed).
+
+    Pass a granularity when the lake holds more than one, or the rows of each granularity are all returned.
+    """
+    dataset = lake_dataset(root)
+    columns = columns or ['StationID'] + LAKE_COLUMNS
+    table = dataset.to_table(columns=columns, filter=lake_filter(dataset, stations, start_date, end_date, granularity))
+    return table.to_pandas()
+
+
+def iter_lake(root: str, stations: Optional[Iterable[int]] = None, start_date: Optional[date] = None,
+              end_date: Optional[date] = None, columns: Optional[List[str]] = None,
+              batch_size: int = 1 << 20, granularity: Optional[str] = None) -> Iterator[pd.DataFrame]:
+    """Stream the rows of some stations and dates as DataFrames of at most batch_size rows."""
+    dataset = lake_dataset(root)
+    columns = columns or ['StationID'] + LAKE_COLUMNS
+    for batch in dataset.to_batches(columns=columns, filter=lake_filter(dataset, stations, start_date, end_date, granularity),
+                                    batch_size=batch_size):
+        if batch.num_rows:
+            yield batch.to_pandas()
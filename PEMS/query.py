@@ -23,6 +23,10 @@ def process_traffic_data(raw_data_df):
             'Speed': 'AvgOfSpeed'
         }))
 
+    return summarize_sum_of_lanes(query1_df)
+
+# Queries 3 to 1 from the sum of lanes (query 4): date parts, daily and monthly aggregation
+def summarize_sum_of_lanes(query1_df):
     # Query 3 - Add date parts
     query2_df = query1_df.assign(
         DayDate=query1_df['ReadingDateTime'].dt.day,
@@ -58,6 +62,40 @@ def process_traffic_data(raw_data_df):
 
     return query1_df, query2_df, query3_df, query4_df
 
+# Same queries as process_traffic_data, read from the partitioned Parquet lake of pems_lake (downloader.py)
+# Only the stations and dates asked for are read, in batches, so the raw data never has to fit in memory:
+# each batch is reduced to per station and datetime sums (volume, speed and speed readings) before the
+# batches are combined into the sum of lanes. A lake holding several granularities needs one picked, since
+# summing 5min and hourly rows together would count the same traffic twice.
+def process_traffic_lake(lake, stations=None, start_date=None, end_date=None, batch_size=1 << 20, granularity=None):
+    from pems_lake import iter_lake, lake_granularities
+
+    if granularity is None and len(granularities := lake_granularities(lake)) > 1:
+        raise ValueError(f"{lake} holds several granularities ({', '.join(granularities)}); pass granularity")
+
+    partials = []
+    for batch in iter_lake(lake, stations, start_date, end_date, batch_size=batch_size, granularity=granularity):
+        partials.append(batch
+            .groupby(['StationID', 'ReadingDateTime'])
+            .agg(Volume=('Volume', 'sum'), SpeedSum=('Speed', 'sum'), SpeedCount=('Speed', 'count'))
+            .reset_index())
+    if not partials:
+        raise ValueError(f"No data in {lake} for the stations and dates requested")
+
+    # Query 4 (bottom query) - Sum volumes and average speeds by station and datetime
+    sums = (pd.concat(partials, ignore_index=True)
+        .groupby(['StationID', 'ReadingDateTime'])
+        .sum()
+        .reset_index())
+    query1_df = pd.DataFrame({
+        'StationID': sums['StationID'],
+        'ReadingDateTime': sums['ReadingDateTime'],
+        'SumOfVolume': sums['Volume'],
+        'AvgOfSpeed': sums['SpeedSum'] / sums['SpeedCount'].where(sums['SpeedCount'] > 0)
+    })
+
+    return summarize_sum_of_lanes(query1_df)
+
 
 # def monthly_figure(MonthlyAve):
 #     # Determine pair of stations with the highest volumes
@@ -78,44 +116,45 @@ def process_traffic_data(raw_data_df):
 # Assuming you have your raw data in a pandas DataFrame with columns:
 # StationID, ReadingDateTime, Volume, Speed
 
-raw_df = pd.read_csv('data/RawData.csv')
-try:
-    # Try to convert with coerce to handle any invalid dates
-    raw_df['ReadingDateTime'] = pd.to_datetime(
-        raw_df['ReadingDateTime'], 
-        format='mixed',  # Allow mixed formats
-        errors='coerce'  # Replace invalid dates with NaT
-    )
+if __name__ == "__main__":
+    raw_df = pd.read_csv('data/RawData.csv')
+    try:
+        # Try to convert with coerce to handle any invalid dates
+        raw_df['ReadingDateTime'] = pd.to_datetime(
+            raw_df['ReadingDateTime'], 
+            format='mixed',  # Allow mixed formats
+            errors='coerce'  # Replace invalid dates with NaT
+        )
     
-    # Check for and report any NaT (invalid) values
-    invalid_dates = raw_df[raw_df['ReadingDateTime'].isna()]
-    if len(invalid_dates) > 0:
-        print(f"Found {len(invalid_dates)} invalid dates:")
-        print(invalid_dates)
+        # Check for and report any NaT (invalid) values
+        invalid_dates = raw_df[raw_df['ReadingDateTime'].isna()]
+        if len(invalid_dates) > 0:
+            print(f"Found {len(invalid_dates)} invalid dates:")
+            print(invalid_dates)
         
-    # Remove any rows with invalid dates
-    raw_df = raw_df.dropna(subset=['ReadingDateTime'])
+        # Remove any rows with invalid dates
+        raw_df = raw_df.dropna(subset=['ReadingDateTime'])
     
-except Exception as e:
-    print("Error converting dates:", e)
-    raise
-
-print("DataFrame info:")
-print(raw_df.info())
-print("\nFirst few rows:")
-print(raw_df.head())
-
-q1, q2, q3, q4 = process_traffic_data(raw_df)
-
-
-print("SumofLanes")
-print(q1)
-print("SumofLaneswithDates")
-print(q2)
-print("DailyVolumesbyMonth")
-print(q3)
-print("DailyVolumesbyMonthAve")
-print(q4)
+    except Exception as e:
+        print("Error converting dates:", e)
+        raise
+
+    print("DataFrame info:")
+    print(raw_df.info())
+    print("\nFirst few rows:")
+    print(raw_df.head())
+
+    q1, q2, q3, q4 = process_traffic_data(raw_df)
+
+
+    print("SumofLanes")
+    print(q1)
+    print("SumofLaneswithDates")
+    print(q2)
+    print("DailyVolumesbyMonth")
+    print(q3)
+    print("DailyVolumesbyMonthAve")
+    print(q4)
 
 
 